@@ -0,0 +1,286 @@
+import os
+import sys
+import json
+import math
+import sqlite3
+import argparse
+import numpy as np
+from pathlib import Path
+from typing import NamedTuple
+
+# Import local module
+import pynavlab
+import navpos
+import simplify
+import batch
+
+# archiveindex.py
+# Persistent spatial and temporal index over a whole mission archive, to find missions that passed a place in a time window.
+# Every trajectory (navp from navpos.txt, else the default navlab solution) is thinned to one position per step seconds
+# and split into short segments. The bounding box and time range of each segment go into an SQLite R*Tree, the positions
+# themselves into a blob for the exact distance check. Missions whose input did not change are skipped on update.
+# Joakim Skjefstad
+
+default_index_filename = "archiveindex.sqlite"
+default_step = 1.0 # seconds between indexed positions
+default_segment_points = 120 # positions per segment, about 2 minutes at the default step
+
+class ArchiveMatch(NamedTuple):
+    mission_path: str
+    mission_name: str
+    first_time: float # first indexed time in the query area and window
+    last_time: float
+    distance: float # metres to the query point, 0 for bounding box queries
+
+def mission_source(mission_folder_path: Path):
+    """The trajectory file to index and its kind, navp if the mission has navpos.txt, else the default navlab."""
+    mission_folder_path = Path(mission_folder_path)
+    navpos_file_path = mission_folder_path / navpos.navpos_file_relative_path
+    if navpos_file_path.exists() and (mission_folder_path / navpos.format_file_relative_path).exists():
+        return "navp", navpos_file_path
+    navlab_file_path = mission_folder_path / "post" / "navlab_smooth.bin"
+    if navlab_file_path.exists():
+        return "navlab", navlab_file_path
+    return None, None
+
+def read_positions(mission_folder_path: Path, source):
+    """Time, lon and lat of a mission's trajectory with the existing readers, sorted by time."""
+    if source == "navp":
+        arrays = navpos.NavposReader(mission_folder_path).read_arrays(navpos.position_channels)
+        time, lat, lon = (np.asarray(arrays[channel], dtype=np.float64) for channel in navpos.position_channels)
+    else:
+        records = pynavlab.read_navlab_smooth_to_array(Path(mission_folder_path) / "post" / "navlab_smooth.bin")
+        block = pynavlab.records_to_array(records, ["timestamp", "lon", "lat"])
+        time, lon, lat = block["timestamp"], block["lon"], block["lat"]
+    valid = np.isfinite(time) & np.isfinite(lon) & np.isfinite(lat)
+    time, lon, lat = time[valid], lon[valid], lat[valid]
+    order = np.argsort(time, kind="stable")
+    return time[order], lon[order], lat[order]
+
+def thin_positions(time, lon, lat, step=default_step):
+    """Keep the first position of every step seconds and the last position."""
+    if len(time) == 0:
+        return time, lon, lat
+    bucket = np.floor((time - time[0]) / step)
+    keep = np.concatenate(([True], bucket[1:] != bucket[:-1]))
+    keep[-1] = True
+    return time[keep], lon[keep], lat[keep]
+
+def mission_segments(mission_folder_path: Path, step=default_step, segment_points=default_segment_points):
+    """Segments of a mission as (start, end, min lon, max lon, min lat, max lat, positions blob). Consecutive segments
+    share their end position so the line between them is covered."""
+    source, _ = mission_source(mission_folder_path)
+    time, lon, lat = thin_positions(*read_positions(mission_folder_path, source), step)
+    segments = []
+    for first in range(0, max(len(time) - 1, 1), segment_points):
+        last = min(first + segment_points + 1, len(time))
+        if last <= first:
+            break
+        points = np.column_stack((time[first:last], lon[first:last], lat[first:last]))
+        segments.append((float(points[0, 0]), float(points[-1, 0]), float(points[:, 1].min()), float(points[:, 1].max()),
+                         float(points[:, 2].min()), float(points[:, 2].max()), points.astype('<f8').tobytes()))
+    return segments
+
+def source_signature(mission_folder_path: Path):
+    source, source_path = mission_source(mission_folder_path)
+    if source is None:
+        return None
+    stat = os.stat(source_path)
+    return json.dumps({"source": source, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns})
+
+def polyline_distances(x, y):
+    """Distance from the origin to every segment of the polyline (x, y), in the units of x and y."""
+    if len(x) == 1:
+        return np.hypot(x, y)
+    x0, y0, x1, y1 = x[:-1], y[:-1], x[1:], y[1:]
+    dx, dy = x1 - x0, y1 - y0
+    length_squared = dx * dx + dy * dy
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = np.where(length_squared > 0, np.clip(-(x0 * dx + y0 * dy) / length_squared, 0.0, 1.0), 0.0)
+    return np.hypot(x0 + t * dx, y0 + t * dy)
+
+class ArchiveIndex:
+    """SQLite index of mission trajectories, R*Tree over (lon, lat, time) of every segment."""
+
+    def __init__(self, index_path=default_index_filename):
+        self.index_path = Path(index_path)
+        self.connection = sqlite3.connect(self.index_path)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS missions (id INTEGER PRIMARY KEY, path TEXT UNIQUE, name TEXT, signature TEXT, "
+                                    "start_time REAL, end_time REAL, step REAL, segment_points INTEGER)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS segments (id INTEGER PRIMARY KEY, mission_id INTEGER, start_time REAL, end_time REAL, positions BLOB)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS segments_mission ON segments (mission_id)")
+            # R*Tree bounds are 32-bit floats rounded outwards, exact times and positions are checked from the blobs
+            self.connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS segments_rtree USING rtree(id, min_lon, max_lon, min_lat, max_lat, start_time, end_time)")
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def stale_missions(self, mission_folders, step=default_step, segment_points=default_segment_points):
+        """Mission-folders that are new, or whose trajectory file or indexing parameters changed."""
+        known = {path: (signature, known_step, known_points)
+                 for path, signature, known_step, known_points in self.connection.execute("SELECT path, signature, step, segment_points FROM missions")}
+        stale = []
+        for mission_folder in mission_folders:
+            signature = source_signature(mission_folder)
+            if signature is not None and known.get(str(Path(mission_folder).resolve())) != (signature, step, segment_points):
+                stale.append(mission_folder)
+        return stale
+
+    def remove_mission(self, path):
+        with self.connection:
+            row = self.connection.execute("SELECT id FROM missions WHERE path = ?", (str(path),)).fetchone()
+            if row is None:
+                return
+            self.connection.execute("DELETE FROM segments_rtree WHERE id IN (SELECT id FROM segments WHERE mission_id = ?)", row)
+            self.connection.execute("DELETE FROM segments WHERE mission_id = ?", row)
+            self.connection.execute("DELETE FROM missions WHERE id = ?", row)
+
+    def add_mission(self, mission_folder_path, signature, segments, step=default_step, segment_points=default_segment_points):
+        """Replace the segments of one mission."""
+        path = str(Path(mission_folder_path).resolve())
+        self.remove_mission(path)
+        if not segments:
+            return
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO missions (path, name, signature, start_time, end_time, step, segment_points) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path, Path(path).name, signature, segments[0][0], segments[-1][1], step, segment_points))
+            mission_id = cursor.lastrowid
+            for start, end, min_lon, max_lon, min_lat, max_lat, positions in segments:
+                segment_id = self.connection.execute("INSERT INTO segments (mission_id, start_time, end_time, positions) VALUES (?, ?, ?, ?)",
+                                                     (mission_id, start, end, positions)).lastrowid
+                self.connection.execute("INSERT INTO segments_rtree VALUES (?, ?, ?, ?, ?, ?, ?)", (segment_id, min_lon, max_lon, min_lat, max_lat, start, end))
+
+    def update(self, mission_folders, workers=None, step=default_step, segment_points=default_segment_points, prune=False):
+        """Index new and changed missions, reading trajectories in a process pool. With prune, drop missions not given.
+        Returns the indexed mission-folders and those that failed."""
+        mission_folders = list(mission_folders)
+        if prune:
+            present = {str(Path(mission_folder).resolve()) for mission_folder in mission_folders}
+            for (path,) in self.connection.execute("SELECT path FROM missions").fetchall():
+                if path not in present:
+                    self.remove_mission(path)
+        stale = self.stale_missions(mission_folders, step, segment_points)
+        print(f"{len(stale)} of {len(mission_folders)} missions to index.")
+        signatures = {mission_folder: source_signature(mission_folder) for mission_folder in stale}
+        results, failed = batch.run_batch(mission_segments, stale, workers, step=step, segment_points=segment_points) if stale else ({}, [])
+        for mission_folder, segments in results.items():
+            self.add_mission(mission_folder, signatures[mission_folder], segments, step, segment_points)
+        return list(results), failed
+
+    def candidates(self, min_lon, min_lat, max_lon, max_lat, start=None, end=None):
+        """Segments whose bounding box and time range overlap the query, as (mission path, name, positions)."""
+        start = -math.inf if start is None else pynavlab.to_epoch_seconds(start)
+        end = math.inf if end is None else pynavlab.to_epoch_seconds(end)
+        return self.connection.execute(
+            "SELECT missions.path, missions.name, segments.positions FROM segments_rtree "
+            "JOIN segments ON segments.id = segments_rtree.id JOIN missions ON missions.id = segments.mission_id "
+            "WHERE segments_rtree.max_lon >= ? AND segments_rtree.min_lon <= ? AND segments_rtree.max_lat >= ? AND segments_rtree.min_lat <= ? "
+            "AND segments_rtree.end_time >= ? AND segments_rtree.start_time <= ?",
+            (min_lon, max_lon, min_lat, max_lat, start, end)).fetchall(), start, end
+
+    @staticmethod
+    def collect(matches, path, name, time, distance):
+        match = matches.get(path)
+        if match is None:
+            matches[path] = ArchiveMatch(path, name, float(time.min()), float(time.max()), distance)
+        else:
+            matches[path] = ArchiveMatch(path, name, min(match.first_time, float(time.min())), max(match.last_time, float(time.max())),
+                                         min(match.distance, distance))
+
+    def query_bbox(self, min_lon, min_lat, max_lon, max_lat, start=None, end=None):
+        """Missions with an indexed position inside the box during [start, end], sorted by first time."""
+        rows, start, end = self.candidates(min_lon, min_lat, max_lon, max_lat, start, end)
+        matches = {}
+        for path, name, positions in rows:
+            time, lon, lat = np.frombuffer(positions, dtype='<f8').reshape(-1, 3).T
+            inside = (lon >= min_lon) & (lon <= max_lon) & (lat >= min_lat) & (lat <= max_lat) & (time >= start) & (time <= end)
+            if inside.any():
+                self.collect(matches, path, name, time[inside], 0.0)
+        return sorted(matches.values(), key=lambda match: match.first_time)
+
+    def query_radius(self, lat, lon, radius, start=None, end=None):
+        """Missions whose track passed within radius metres of (lat, lon) during [start, end], sorted by distance."""
+        lat_margin = math.degrees(radius / simplify.earth_radius)
+        lon_margin = lat_margin / max(math.cos(math.radians(lat)), 1e-6)
+        rows, start, end = self.candidates(lon - lon_margin, lat - lat_margin, lon + lon_margin, lat + lat_margin, start, end)
+        matches = {}
+        for path, name, positions in rows:
+            time, segment_lon, segment_lat = np.frombuffer(positions, dtype='<f8').reshape(-1, 3).T
+            in_window = (time >= start) & (time <= end)
+            if not in_window.any():
+                continue
+            time, segment_lon, segment_lat = time[in_window], segment_lon[in_window], segment_lat[in_window]
+            x, y = simplify.project_local(segment_lon, segment_lat, lon, lat)
+            distances = polyline_distances(x, y)
+            # Times of the positions at either end of every line piece within radius
+            near = distances <= radius
+            if not near.any():
+                continue
+            if len(time) == 1:
+                near_positions = near
+            else:
+                near_positions = np.zeros(len(time), dtype=bool)
+                near_positions[:-1] |= near
+                near_positions[1:] |= near
+            self.collect(matches, path, name, time[near_positions], float(distances.min()))
+        return sorted(matches.values(), key=lambda match: match.distance)
+
+    def query_time(self, start=None, end=None):
+        """Missions with indexed positions in [start, end], sorted by start time."""
+        start = -math.inf if start is None else pynavlab.to_epoch_seconds(start)
+        end = math.inf if end is None else pynavlab.to_epoch_seconds(end)
+        rows = self.connection.execute("SELECT path, name, start_time, end_time FROM missions WHERE end_time >= ? AND start_time <= ? ORDER BY start_time",
+                                       (start, end)).fetchall()
+        return [ArchiveMatch(path, name, max(start_time, start), min(end_time, end), 0.0) for path, name, start_time, end_time in rows]
+
+def print_matches(matches):
+    for match in matches:
+        first_time = pynavlab.timestamps_to_microseconds(match.first_time).astype('datetime64[us]')
+        last_time = pynavlab.timestamps_to_microseconds(match.last_time).astype('datetime64[us]')
+        print(f"{match.mission_name}\t{first_time} - {last_time}\t{match.distance:.0f} m\t{match.mission_path}")
+    print(f"{len(matches)} missions.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and query a spatial and temporal index of mission-folders.")
+    parser.add_argument("--index", type=Path, default=Path(default_index_filename), help=f"Index file (default: {default_index_filename}).")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    update_parser = subparsers.add_parser("update", help="Index new and changed mission-folders.")
+    update_parser.add_argument("missions", nargs="+", help="Mission-folders, root folders of mission-folders or glob patterns.")
+    update_parser.add_argument("-j", "--workers", type=batch.positive_int, default=os.cpu_count(), help="Missions read in parallel (default: number of cores).")
+    update_parser.add_argument("--step", type=float, default=default_step, help=f"Seconds between indexed positions (default: {default_step}).")
+    update_parser.add_argument("--prune", action="store_true", help="Remove indexed missions that are not among the given folders.")
+    radius_parser = subparsers.add_parser("radius", help="Missions that passed within a distance of a point.")
+    radius_parser.add_argument("lat", type=float)
+    radius_parser.add_argument("lon", type=float)
+    radius_parser.add_argument("metres", type=float)
+    bbox_parser = subparsers.add_parser("bbox", help="Missions with positions inside a bounding box.")
+    for name in ("min_lon", "min_lat", "max_lon", "max_lat"):
+        bbox_parser.add_argument(name, type=float)
+    time_parser = subparsers.add_parser("time", help="Missions logged in a time window.")
+    for query_parser in (radius_parser, bbox_parser, time_parser):
+        query_parser.add_argument("--start", default=None, help="Start of the time window, ISO 8601 UTC or seconds since 1970.")
+        query_parser.add_argument("--end", default=None, help="End of the time window, ISO 8601 UTC or seconds since 1970.")
+    args = parser.parse_args()
+
+    with ArchiveIndex(args.index) as index:
+        if args.command == "update":
+            _, failed = index.update(batch.mission_folders_from_arguments(update_parser, args.missions), args.workers, args.step, prune=args.prune)
+            if failed:
+                sys.exit(batch.exit_status(failed))
+        else:
+            start = float(args.start) if args.start and args.start.replace('.', '', 1).isdigit() else args.start
+            end = float(args.end) if args.end and args.end.replace('.', '', 1).isdigit() else args.end
+            if args.command == "radius":
+                print_matches(index.query_radius(args.lat, args.lon, args.metres, start, end))
+            elif args.command == "bbox":
+                print_matches(index.query_bbox(args.min_lon, args.min_lat, args.max_lon, args.max_lat, start, end))
+            else:
+                print_matches(index.query_time(start, end))
@@ -0,0 +1,130 @@
+import os
+import sys
+import glob
+import argparse
+import traceback
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Import local module
+import stagetiming
+
+# batch.py
+# Shared non-interactive command line for the conversion scripts, runs many mission folders in a process pool.
+# Joakim Skjefstad
+
+# Any of these marks a folder as a mission-folder
+mission_markers = [
+    Path("mission.mp"),
+    Path("cp", "data", "navpos.txt"),
+    Path("post", "navlab_smooth.bin"),
+]
+
+def is_mission_folder(path: Path):
+    return any((path / marker).exists() for marker in mission_markers)
+
+def expand_pattern(pattern):
+    """Mission-folders of one argument: a mission-folder, a root folder holding mission-folders or a glob pattern."""
+    mission_folders = []
+    matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+    for match in matches:
+        path = Path(match)
+        if not path.is_dir():
+            continue
+        if is_mission_folder(path):
+            mission_folders.append(path)
+        else:
+            # A root folder, take the mission-folders directly below it
+            mission_folders.extend(child for child in sorted(path.iterdir()) if child.is_dir() and is_mission_folder(child))
+    return mission_folders
+
+def find_mission_folders(patterns):
+    """Expand mission-folders, root folders holding mission-folders, and glob patterns into mission-folders."""
+    return list(dict.fromkeys(mission_folder for pattern in patterns for mission_folder in expand_pattern(pattern)))
+
+def mission_folders_from_arguments(parser: argparse.ArgumentParser, patterns):
+    """find_mission_folders for command line arguments, a usage error names every argument that found nothing."""
+    unresolved = [pattern for pattern in patterns if not expand_pattern(pattern)]
+    if unresolved:
+        parser.error(f"no mission-folders found for {', '.join(unresolved)}")
+    return find_mission_folders(patterns)
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+def add_batch_arguments(parser: argparse.ArgumentParser, cache=False):
+    """Arguments shared by the mission tools, --cache-dir only for tools writing through productcache."""
+    parser.add_argument("missions", nargs="*", help="Mission-folders, root folders of mission-folders or glob patterns. Opens a folder dialog if none are given.")
+    parser.add_argument("-o", "--output-dir", type=Path, default=Path("."), help="Folder to write output to (default: current folder).")
+    parser.add_argument("-j", "--workers", type=positive_int, default=os.cpu_count(), help="Number of missions processed in parallel (default: number of cores).")
+    if cache:
+        parser.add_argument("--cache-dir", type=Path, default=None, help="Product cache folder, outputs of unchanged inputs are not regenerated.")
+    parser.add_argument("--profile", action=stagetiming.EnableProfiling, help=f"Write <mission>_<tool>_profile.json with stage timings (or set {stagetiming.environment_variable}=1).")
+
+def print_failure(mission_folder, error):
+    # Errors from a worker process carry the worker traceback as their cause, printed here as well
+    print(f"Failed: {mission_folder}: {error}")
+    print("".join(traceback.format_exception(error)), end="")
+
+def run_batch(function, mission_folders, workers=None, **kwargs):
+    """Call function(mission_folder, **kwargs) for every mission-folder in a process pool.
+    Returns {mission_folder: result} and the list of mission-folders that failed."""
+    results = {}
+    failed = []
+    if stagetiming.enabled():
+        # Tool name from the script that was run, so tools writing to the same folder keep separate reports
+        kwargs = {"profiled_function": function, "tool": Path(sys.argv[0]).stem or None, **kwargs}
+        function = stagetiming.run_profiled
+    if workers is None or workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(function, mission_folder, **kwargs): mission_folder for mission_folder in mission_folders}
+            for future in as_completed(futures):
+                mission_folder = futures[future]
+                try:
+                    results[mission_folder] = future.result()
+                    print(f"Done: {mission_folder}")
+                except Exception as error:
+                    failed.append(mission_folder)
+                    print_failure(mission_folder, error)
+    else:
+        for mission_folder in mission_folders:
+            try:
+                results[mission_folder] = function(mission_folder, **kwargs)
+                print(f"Done: {mission_folder}")
+            except Exception as error:
+                failed.append(mission_folder)
+                print_failure(mission_folder, error)
+
+    print(f"Processed {len(results)} of {len(mission_folders)} missions, {len(failed)} failed.")
+    return results, failed
+
+def exit_status(failed):
+    """Process exit status of a tool, non-zero when any mission failed."""
+    return 1 if failed else 0
+
+def select_mission_folder():
+    # Imported here, only needed for the dialog
+    from tkinter import Tk
+    from tkinter.filedialog import askdirectory
+    Tk().withdraw()
+
+    mission_folder = askdirectory(title="Select missionfolder")
+    if not mission_folder:
+        print("No folder selected. Exiting.")
+        return []
+    return Path(mission_folder)
+
+def run_tool(parser: argparse.ArgumentParser, args, function, **kwargs):
+    """run_batch over the mission-folders of args.missions, or over the folder selected in a dialog when none are given.
+    Returns the exit status of the tool."""
+    missions = args.missions
+    if not missions:
+        mission_folder_path = select_mission_folder()
+        if not mission_folder_path:
+            return 0
+        missions = [str(mission_folder_path)]
+    _, failed = run_batch(function, mission_folders_from_arguments(parser, missions), args.workers, **kwargs)
+    return exit_status(failed)
@@ -0,0 +1,174 @@
+import io
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+from pathlib import Path
+from typing import NamedTuple, Callable
+
+# Import local module
+import pynavlab
+import navpos
+import mp2geojson
+import navp2geojson
+import navigation2geojson
+import navlabversions
+import syntheticmission
+
+# benchmark.py
+# Throughput, latency and peak memory of the readers and exporters, on a synthetic mission-folder (syntheticmission.py)
+# or a real one. Results can be saved as JSON and compared with an earlier run to see regressions and speedups.
+# Peak memory is what Python and NumPy allocate (tracemalloc), measured in a separate untimed run.
+# Joakim Skjefstad
+
+default_repeat = 3
+
+class Benchmark(NamedTuple):
+    name: str
+    run: Callable # called with the output directory
+    records: int # records read or written by one run
+    bytes: int # input bytes read by one run
+
+class BenchmarkResult(NamedTuple):
+    name: str
+    seconds: float # fastest run
+    records_per_second: float
+    megabytes_per_second: float
+    peak_megabytes: float
+
+def file_size(path):
+    return Path(path).stat().st_size if Path(path).exists() else 0
+
+def mission_benchmarks(mission_folder_path: Path):
+    """The benchmarks that apply to a mission-folder, each reading or exporting one of its files."""
+    mission_folder_path = Path(mission_folder_path)
+    navlab_path = mission_folder_path / "post" / "navlab_smooth.bin"
+    navpos_path = mission_folder_path / navpos.navpos_file_relative_path
+    mission_plan_path = mission_folder_path / "mission.mp"
+    benchmarks = []
+
+    if navlab_path.exists():
+        navlab_bytes = file_size(navlab_path)
+        navlab_records = navlab_bytes // pynavlab.bytes_per_row
+        records = pynavlab.read_navlab_smooth_to_array(navlab_path)
+        middle = float(records[len(records) // 2]["timestamp"]) if len(records) else 0.0
+        first, last = pynavlab.time_window_indices(records, middle, middle + 60)
+        slice_records = last - first
+        columns = ["timestamp", "lat", "lon", "depth"]
+        benchmarks += [
+            Benchmark("navlab dataframe", lambda output_dir: pynavlab.read_navlab_smooth_to_dataframe(navlab_path, columns, nth_row=1),
+                      navlab_records, navlab_bytes),
+            Benchmark("navlab blocks", lambda output_dir: sum(len(block) for block in pynavlab.iter_navlab_smooth(navlab_path, columns, as_dataframe=False)),
+                      navlab_records, navlab_bytes),
+            Benchmark("navlab csv", lambda output_dir: pynavlab.write_navlab_smooth_csv(navlab_path, output_dir / "navlab.csv", columns, nth_row=10),
+                      navlab_records // 10, navlab_bytes),
+            Benchmark("navlab geojson", lambda output_dir: navigation2geojson.navlab_to_geojson_file(navlab_path, output_dir / "navlab.geojson"),
+                      navlab_records // 10, navlab_bytes),
+            # Latency of a single lookup, only a few records are read
+            Benchmark("navlab at_time", lambda output_dir: pynavlab.at_time(navlab_path, middle), 1, 2 * pynavlab.bytes_per_row),
+            Benchmark("navlab slice 60 s", lambda output_dir: pynavlab.slice_by_time(navlab_path, middle, middle + 60, columns),
+                      slice_records, slice_records * pynavlab.bytes_per_row),
+        ]
+        default_navlab, alternative_navlab = navigation2geojson.find_navlab_paths(mission_folder_path)
+        version_bytes = sum(file_size(path) for path in [default_navlab] + alternative_navlab)
+        benchmarks.append(Benchmark("navlab versions", lambda output_dir: navlabversions.compare_navlab_versions(default_navlab, alternative_navlab),
+                                    version_bytes // pynavlab.bytes_per_row, version_bytes))
+
+    if navpos_path.exists():
+        navpos_bytes = file_size(navpos_path)
+        with open(navpos_path, 'rb') as navpos_file:
+            navpos_records = sum(1 for _ in navpos_file)
+        channels = navpos.position_channels
+        benchmarks += [
+            Benchmark("navpos text", lambda output_dir: navpos.read_navpos(mission_folder_path, channels, use_cache=False), navpos_records, navpos_bytes),
+            Benchmark("navpos sidecar", lambda output_dir: navpos.read_navpos(mission_folder_path, channels), navpos_records, navpos_bytes),
+            Benchmark("navp geojson", lambda output_dir: navp2geojson.write_navp_geojson(mission_folder_path, output_dir / "navp.geojson"),
+                      navpos_records, navpos_bytes),
+        ]
+
+    if mission_plan_path.exists():
+        mission_plan_bytes = file_size(mission_plan_path)
+        with open(mission_plan_path, 'r') as mission_plan:
+            waypoints = sum(1 for line in mission_plan if line.startswith(":"))
+        benchmarks += [
+            Benchmark("mission plan parse", lambda output_dir: mp2geojson.parse_missionplan(mission_plan_path), waypoints, mission_plan_bytes),
+            Benchmark("mission plan geojson", lambda output_dir: mp2geojson.convert_mission(mission_folder_path, output_dir),
+                      waypoints, mission_plan_bytes),
+        ]
+    return benchmarks
+
+def run_benchmark(benchmark, output_dir, repeat=default_repeat):
+    """Peak memory of one run under tracemalloc and the fastest of repeat timed runs. Tool output is discarded."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        # Untimed first run, so lazy imports and a cold page cache count in neither measurement
+        benchmark.run(output_dir)
+        tracemalloc.start()
+        try:
+            benchmark.run(output_dir)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        seconds = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            benchmark.run(output_dir)
+            seconds = min(seconds, time.perf_counter() - start)
+
+    seconds = max(seconds, 1e-9)
+    return BenchmarkResult(benchmark.name, seconds, benchmark.records / seconds, benchmark.bytes / 1e6 / seconds, peak / 1e6)
+
+def run_benchmarks(mission_folder_path, repeat=default_repeat, selected=None):
+    results = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        benchmarks = mission_benchmarks(mission_folder_path)
+    with tempfile.TemporaryDirectory() as output_dir:
+        for benchmark in benchmarks:
+            if selected and not any(name in benchmark.name for name in selected):
+                continue
+            result = run_benchmark(benchmark, Path(output_dir), repeat)
+            results.append(result)
+            print_result(result)
+    return results
+
+def print_result(result, baseline=None):
+    line = (f"{result.name:22s} {result.seconds * 1000:10.2f} ms {result.records_per_second:14,.0f} rec/s "
+            f"{result.megabytes_per_second:9.1f} MB/s {result.peak_megabytes:9.1f} MB peak")
+    if baseline is not None:
+        line += f"  {baseline['seconds'] / result.seconds:5.2f}x vs baseline"
+    print(line)
+
+def compare_with_baseline(results, baseline_path):
+    """Print every result with its speedup against a saved run, above 1 is faster than the baseline."""
+    with open(baseline_path, 'r') as baseline_file:
+        baseline = {result["name"]: result for result in json.load(baseline_file)["results"]}
+    print(f"\nCompared with {baseline_path}:")
+    for result in results:
+        print_result(result, baseline.get(result.name))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the readers and exporters on a synthetic or real mission-folder.")
+    parser.add_argument("mission", nargs="?", help="Mission-folder to benchmark, a synthetic one is generated if not given.")
+    parser.add_argument("--duration", type=float, default=3600.0, help="Length of the synthetic mission in seconds (default: 3600).")
+    parser.add_argument("--repeat", type=int, default=default_repeat, help=f"Timed runs per benchmark, the fastest counts (default: {default_repeat}).")
+    parser.add_argument("--only", nargs="+", default=None, help="Only run benchmarks whose name contains one of these.")
+    parser.add_argument("--save", default=None, help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", default=None, help="JSON file of an earlier run to compare with.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as synthetic_dir:
+        mission_folder_path = args.mission
+        if mission_folder_path is None:
+            mission_folder_path = syntheticmission.generate_mission(Path(synthetic_dir) / "synthetic", duration=args.duration)
+            print(f"Synthetic mission of {args.duration:.0f} s")
+        results = run_benchmarks(mission_folder_path, args.repeat, args.only)
+
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            json.dump({"mission": str(args.mission or "synthetic"), "python": sys.version.split()[0],
+                       "results": [result._asdict() for result in results]}, results_file, indent=2)
+    if args.baseline:
+        compare_with_baseline(results, args.baseline)
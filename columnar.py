@@ -0,0 +1,161 @@
+import sys
+import argparse
+import numpy as np
+from pathlib import Path
+
+# Import local module
+import pynavlab
+import navpos
+import batch
+
+# columnar.py
+# Parquet export of navlab (navlab_smooth.bin, postea) and navp (navpos.txt) data.
+# Every column is typed (float64, UTC timestamp), row groups hold a fixed time span so readers can skip
+# to the columns and time ranges they need using the row group statistics.
+# Needs pyarrow, which is only imported when exporting: pip install pyarrow
+# Joakim Skjefstad
+
+default_row_group_seconds = 3600 # time span of one row group
+default_compression = "zstd"
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as error:
+        raise ImportError("Parquet export needs pyarrow, install it with: pip install pyarrow") from error
+    return pyarrow, pyarrow.parquet
+
+def time_buckets(timestamps, row_group_seconds):
+    """Split positions of an ordered timestamp array where it crosses a row_group_seconds boundary."""
+    buckets = np.floor(np.asarray(timestamps) / row_group_seconds)
+    return buckets, np.flatnonzero(np.diff(buckets)) + 1
+
+class TimePartitionedWriter:
+    """Collects column blocks and writes one Parquet row group per time bucket."""
+
+    def __init__(self, parquet_path, schema, row_group_seconds=default_row_group_seconds, compression=default_compression):
+        self.pa, self.pq = import_pyarrow()
+        self.schema = schema
+        self.row_group_seconds = row_group_seconds
+        self.writer = self.pq.ParquetWriter(parquet_path, schema, compression=compression)
+        self.pieces = []
+        self.bucket = None
+
+    def flush(self):
+        if self.pieces:
+            table = self.pa.concat_tables(self.pieces)
+            self.writer.write_table(table, row_group_size=max(table.num_rows, 1))
+        self.pieces = []
+
+    def write(self, timestamps, columns):
+        """Write a block of rows. columns maps names in the schema to arrays, timestamps are seconds since 1970-01-01."""
+        if len(timestamps) == 0:
+            return
+        buckets, splits = time_buckets(timestamps, self.row_group_seconds)
+        for start, end in zip(np.concatenate(([0], splits)), np.concatenate((splits, [len(timestamps)]))):
+            if self.bucket is not None and buckets[start] != self.bucket:
+                self.flush()
+            self.bucket = buckets[start]
+            self.pieces.append(self.pa.table({name: values[start:end] for name, values in columns.items()}, schema=self.schema))
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def datetime_array(timestamps):
+    """UTC timestamps in microseconds, same rounding as the navlab datetime column."""
+    return pynavlab.timestamps_to_microseconds(timestamps).astype('datetime64[us]')
+
+def write_navlab_parquet(filepath, parquet_path, filter_columns=None, nth_row=1, row_group_seconds=default_row_group_seconds,
+                         compression=default_compression, block_size=1_000_000):
+    """Write navlab_smooth.bin to Parquet. Defaults to every NavlabRow column plus a UTC 'datetime' column."""
+    pa, _ = import_pyarrow()
+    if filter_columns is None:
+        filter_columns = ["datetime"] + list(pynavlab.NavlabRow._fields)
+    elif "datetime" in filter_columns:
+        # datetime first, like the navpos Parquet files
+        filter_columns = ["datetime"] + [column for column in filter_columns if column != "datetime"]
+    schema = pa.schema([(column, pa.timestamp('us', tz='UTC') if column == "datetime" else pa.float64()) for column in filter_columns])
+
+    with TimePartitionedWriter(parquet_path, schema, row_group_seconds, compression) as writer:
+        read_columns = list(dict.fromkeys(["timestamp"] + [column for column in filter_columns if column != "datetime"]))
+        for block in pynavlab.iter_navlab_smooth(filepath, read_columns, nth_row=nth_row, block_size=block_size, as_dataframe=False):
+            columns = {column: datetime_array(block["timestamp"]) if column == "datetime" else block[column] for column in filter_columns}
+            writer.write(block["timestamp"], columns)
+    return parquet_path
+
+def navpos_column_name(schema, channel):
+    """Field name as column name, GROUP.FIELD where the field name is used in several groups."""
+    if channel.column == schema.column('Time'):
+        return 'Time'
+    return channel.name if len(schema.by_name[channel.name]) == 1 else f"{channel.group}.{channel.field}"
+
+def write_navpos_parquet(mission_folder_path: Path, parquet_path, channels=None, row_group_seconds=default_row_group_seconds,
+                         compression=default_compression):
+    """Write navpos.txt to Parquet, every channel in format.txt unless channels are given, plus a UTC 'datetime' column."""
+    pa, _ = import_pyarrow()
+    reader = navpos.NavposReader(mission_folder_path)
+    selected = [reader.schema.lookup('Time')] + (list(reader.schema) if channels is None else [reader.schema.lookup(channel) for channel in channels])
+    # One column per navpos.txt column, Time first
+    selected = list({channel.column: channel for channel in reversed(selected)}.values())[::-1]
+    column_names = [navpos_column_name(reader.schema, channel) for channel in selected]
+
+    # Parse all columns in one pass, then take them by column number
+    reader.read([channel.qualified_name for channel in selected])
+    arrays = {name: np.asarray(reader.arrays[channel.column]) for name, channel in zip(column_names, selected)}
+    timestamps = arrays['Time'].astype(np.float64)
+
+    fields = [("datetime", pa.timestamp('us', tz='UTC'))] + [(name, pa.from_numpy_dtype(values.dtype)) for name, values in arrays.items()]
+    with TimePartitionedWriter(parquet_path, pa.schema(fields), row_group_seconds, compression) as writer:
+        writer.write(timestamps, {"datetime": datetime_array(timestamps), **arrays})
+    return parquet_path
+
+def convert_mission(mission_folder_path: Path, output_dir=Path("."), nth_row=1, row_group_seconds=default_row_group_seconds, compression=default_compression):
+    """Write navpos.txt and every navlab solution of a mission-folder to Parquet files in output_dir."""
+    # Imported here, navigation2geojson pulls in the GeoJSON exporters which this module does not need otherwise
+    import navigation2geojson
+
+    mission_folder_path = Path(mission_folder_path)
+    mission_name = mission_folder_path.name
+    written = []
+    if (mission_folder_path / navpos.navpos_file_relative_path).exists():
+        written.append(write_navpos_parquet(mission_folder_path, Path(output_dir) / f"{mission_name}_navpos.parquet",
+                                            row_group_seconds=row_group_seconds, compression=compression))
+
+    try:
+        default_navlab, alternative_navlab = navigation2geojson.find_navlab_paths(mission_folder_path)
+    except FileNotFoundError as error:
+        # navp-only mission, only the navlab files are left out
+        print(error)
+        default_navlab, alternative_navlab = None, []
+    for solution in ([default_navlab] if default_navlab else []) + alternative_navlab:
+        if not solution.exists():
+            continue
+        version = "" if solution == default_navlab else solution.parent.parent.name
+        written.append(write_navlab_parquet(solution, Path(output_dir) / f"{mission_name}_navlab{version}.parquet", nth_row=nth_row,
+                                            row_group_seconds=row_group_seconds, compression=compression))
+    for path in written:
+        print(f"Wrote {path}")
+    return written
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write navpos.txt and the navlab solutions of mission-folders to Parquet.")
+    batch.add_batch_arguments(parser)
+    parser.add_argument("--nth-row", type=int, default=1, help="Keep every nth navlab row (default: 1).")
+    parser.add_argument("--row-group-seconds", type=float, default=default_row_group_seconds, help="Time span of a row group (default: 3600).")
+    parser.add_argument("--compression", default=default_compression, help="Parquet compression (default: zstd).")
+    args = parser.parse_args(argv)
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    return batch.run_tool(parser, args, convert_mission, output_dir=args.output_dir,
+                          nth_row=args.nth_row, row_group_seconds=args.row_group_seconds, compression=args.compression)
+
+if __name__ == "__main__":
+    sys.exit(main())
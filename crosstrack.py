@@ -0,0 +1,295 @@
+import sys
+import json
+import argparse
+import numpy as np
+from pathlib import Path
+
+# Import local module
+import pynavlab
+import navpos
+import mp2geojson
+import simplify
+import navcompare
+import batch
+
+# crosstrack.py
+# Planned vs actual: cross-track and along-track error of every navigation sample against its mission plan leg.
+# Legs are the lines between consecutive mission.mp waypoints. With --nearest each sample goes to its nearest leg, found
+# through a grid of the legs for plans with many legs. By default the samples follow the plan instead: the active leg
+# ends when the track reaches its end, so a leg flown back over the previous one (A to B to A) is told apart, and
+# the nearest legs are only used to jump ahead when progress was lost. Cross-track error is positive to starboard
+# (right of the leg direction), along-track is the distance from the start of the leg and the along-track error is how
+# far a sample is before the start or past the end of its leg. Per-leg statistics go to JSON.
+# Joakim Skjefstad
+
+grid_leg_threshold = 64 # plans with more legs than this are searched through the grid
+default_cell_size = 100.0 # metres, samples farther than this from every leg are searched brute force
+default_arrival_radius = 20.0 # metres before the end of a leg where the next leg becomes active
+default_min_duration = 30.0 # seconds a later leg must stay clearly nearest before the active leg jumps ahead to it
+switch_margin = 1.0 # metres another leg must be nearer than the active leg, overlapping legs are never switched on distance
+gap_factor = 10 # sample intervals longer than this many times the median are logging gaps
+progress_block = 65536 # samples checked against the active leg at a time
+brute_force_block = 10_000_000 # sample-leg distances computed at a time
+
+def plan_legs(mission_folder_path: Path):
+    """Waypoint tags and lon/lat of the mission plan, legs are between consecutive waypoints with a valid position."""
+    df = mp2geojson.parse_missionplan(Path(mission_folder_path) / "mission.mp")
+    valid = df['Latitude'].notna() & df['Longitude'].notna()
+    return df['Tag'][valid].tolist(), df['Longitude'][valid].to_numpy(dtype=np.float64), df['Latitude'][valid].to_numpy(dtype=np.float64)
+
+def read_track(mission_folder_path: Path, source="navp", nth_row=1):
+    """Time, lon and lat of the actual track from navpos.txt (navp) or post/navlab_smooth.bin (navlab)."""
+    if source == "navp":
+        arrays = navpos.NavposReader(mission_folder_path).read_arrays(navpos.position_channels)
+        time, lat, lon = (np.asarray(arrays[channel], dtype=np.float64)[::nth_row] for channel in navpos.position_channels)
+    else:
+        records = pynavlab.read_navlab_smooth_to_array(Path(mission_folder_path) / "post" / "navlab_smooth.bin", nth_row=nth_row)
+        block = pynavlab.records_to_array(records, ["timestamp", "lon", "lat"])
+        time, lon, lat = block["timestamp"], block["lon"], block["lat"]
+    valid = np.isfinite(time) & np.isfinite(lon) & np.isfinite(lat)
+    return time[valid], lon[valid], lat[valid]
+
+def leg_distances(x, y, x0, y0, x1, y1):
+    """(samples, legs) distance matrix from points to leg segments, all in local metres."""
+    dx, dy = x1 - x0, y1 - y0
+    length_squared = dx * dx + dy * dy
+    rx, ry = x[:, None] - x0, y[:, None] - y0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = np.where(length_squared > 0, np.clip((rx * dx + ry * dy) / length_squared, 0.0, 1.0), 0.0)
+    return np.hypot(rx - t * dx, ry - t * dy)
+
+def nearest_legs_brute_force(x, y, legs):
+    """Index of and distance to the nearest leg of every sample, in blocks of samples to bound memory."""
+    x0, y0, x1, y1 = legs
+    nearest = np.empty(len(x), dtype=np.int64)
+    distance = np.empty(len(x))
+    block = max(1, brute_force_block // max(len(x0), 1))
+    for offset in range(0, len(x), block):
+        distances = leg_distances(x[offset:offset + block], y[offset:offset + block], x0, y0, x1, y1)
+        nearest[offset:offset + block] = np.argmin(distances, axis=1)
+        distance[offset:offset + block] = distances[np.arange(len(distances)), nearest[offset:offset + block]]
+    return nearest, distance
+
+class LegGrid:
+    """Uniform grid of cell_size metres, every leg is listed in each cell within cell_size of it."""
+
+    def __init__(self, legs, cell_size):
+        self.legs = legs
+        self.cell_size = cell_size
+        cells = []
+        for leg, (x0, y0, x1, y1) in enumerate(zip(*legs)):
+            steps = int(np.ceil(np.hypot(x1 - x0, y1 - y0) / cell_size * 2)) + 1
+            t = np.linspace(0.0, 1.0, steps + 1)
+            cx = np.floor((x0 + t * (x1 - x0)) / cell_size).astype(np.int64)
+            cy = np.floor((y0 + t * (y1 - y0)) / cell_size).astype(np.int64)
+            # Sampled every half cell, a point within cell_size of the leg is at most two cells from a sampled point
+            offset_x, offset_y = np.meshgrid(np.arange(-2, 3), np.arange(-2, 3))
+            cx = (cx[:, None] + offset_x.ravel()[None, :]).ravel()
+            cy = (cy[:, None] + offset_y.ravel()[None, :]).ravel()
+            keys = np.unique(self.cell_key(cx, cy))
+            cells.append(np.column_stack((keys, np.full(len(keys), leg))))
+        table = np.concatenate(cells) if cells else np.empty((0, 2), dtype=np.int64)
+        table = table[np.argsort(table[:, 0], kind="stable")]
+        self.keys = table[:, 0]
+        self.cell_legs = table[:, 1]
+
+    @staticmethod
+    def cell_key(cx, cy):
+        return (cx << 32) ^ (cy & 0xFFFFFFFF)
+
+    def nearest_legs(self, x, y):
+        """Nearest leg and distance per sample. Samples with no leg within cell_size fall back to brute force."""
+        nearest = np.full(len(x), -1, dtype=np.int64)
+        distance = np.full(len(x), np.inf)
+        x0, y0, x1, y1 = self.legs
+        sample_keys = self.cell_key(np.floor(x / self.cell_size).astype(np.int64), np.floor(y / self.cell_size).astype(np.int64))
+        cell_keys, inverse = np.unique(sample_keys, return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        boundaries = np.searchsorted(inverse[order], np.arange(len(cell_keys) + 1))
+        for cell, key in enumerate(cell_keys):
+            first, last = np.searchsorted(self.keys, key, side="left"), np.searchsorted(self.keys, key, side="right")
+            if first == last:
+                continue
+            candidates = self.cell_legs[first:last]
+            samples = order[boundaries[cell]:boundaries[cell + 1]]
+            distances = leg_distances(x[samples], y[samples], x0[candidates], y0[candidates], x1[candidates], y1[candidates])
+            best = np.argmin(distances, axis=1)
+            nearest[samples] = candidates[best]
+            distance[samples] = distances[np.arange(len(samples)), best]
+
+        # A nearer leg than cell_size is always listed in the sample's cell, farther samples need the full search
+        far = distance > self.cell_size
+        if far.any():
+            nearest[far], distance[far] = nearest_legs_brute_force(x[far], y[far], self.legs)
+        return nearest, distance
+
+def leg_progress(x, y, legs, leg):
+    """Along-track distance from the start of one leg, the leg length and the distance to the leg of every sample."""
+    x0, y0, x1, y1 = (values[leg:leg + 1] for values in legs)
+    length = float(np.hypot(x1 - x0, y1 - y0)[0])
+    along = ((x - x0) * (x1 - x0) + (y - y0) * (y1 - y0)) / length if length > 0 else np.zeros(len(x))
+    return along, length, leg_distances(x, y, x0, y0, x1, y1)[:, 0]
+
+def first_index(mask):
+    return int(np.argmax(mask)) if mask.any() else None
+
+def sequential_legs(x, y, time, legs, nearest, nearest_distance, arrival_radius=default_arrival_radius, min_duration=default_min_duration):
+    """Leg index following the progress along the plan. The active leg ends when a sample comes within arrival_radius
+    of its end, or when the next leg is clearly nearer and already started (a cut corner). When progress was lost, the
+    active leg jumps ahead to a later leg that stayed clearly nearer for min_duration seconds of samples, time in
+    logging gaps does not count, so gaps and short excursions close to a later leg do not move the active leg."""
+    leg = np.empty(len(x), dtype=np.int64)
+    number_of_legs = len(legs[0])
+    intervals = np.diff(time)
+    median_interval = float(np.median(intervals)) if len(intervals) else 0.0
+    gap = median_interval * gap_factor if median_interval > 0 else np.inf
+
+    active, start = 0, 0
+    while start < len(x):
+        end = min(start + progress_block, len(x))
+        along, length, distance = leg_progress(x[start:end], y[start:end], legs, active)
+
+        reached = None
+        if active + 1 < number_of_legs:
+            next_along, _, next_distance = leg_progress(x[start:end], y[start:end], legs, active + 1)
+            reached = first_index((along >= length - arrival_radius) | ((next_distance < distance - switch_margin) & (next_along >= 0)))
+
+        # Runs of samples clearly nearer to a later leg, split at logging gaps, and how long each has lasted
+        ahead = (nearest[start:end] > active) & (nearest_distance[start:end] < distance - switch_margin)
+        block_time = time[start:end]
+        run_start = np.concatenate(([True], (ahead[1:] != ahead[:-1]) | (np.diff(block_time) > gap)))
+        run_start = np.maximum.accumulate(np.where(run_start, np.arange(len(ahead)), 0))
+        lasted = first_index(ahead & (block_time - block_time[run_start] >= min_duration))
+        jump = int(run_start[lasted]) if lasted is not None else None
+
+        if reached is not None and (jump is None or reached <= jump):
+            leg[start:start + reached] = active
+            active, start = active + 1, start + reached
+        elif jump is not None:
+            leg[start:start + jump] = active
+            active, start = int(nearest[start + lasted]), start + jump
+        else:
+            # Continue with the next block, from the start of a run towards a later leg that is still going on
+            next_start = start + int(run_start[-1]) if ahead[-1] and end < len(x) else end
+            next_start = next_start if next_start > start else end
+            leg[start:next_start] = active
+            start = next_start
+    return leg
+
+def project_track(lon, lat, plan_lon, plan_lat):
+    """Samples and legs (x0, y0, x1, y1) in local metres around the middle of the plan."""
+    lon0, lat0 = float(np.mean(plan_lon)), float(np.mean(plan_lat))
+    px, py = simplify.project_local(plan_lon, plan_lat, lon0, lat0)
+    x, y = simplify.project_local(lon, lat, lon0, lat0)
+    return x, y, (px[:-1], py[:-1], px[1:], py[1:])
+
+def track_errors(time, lon, lat, plan_lon, plan_lat, sequential=True, min_duration=default_min_duration, cell_size=default_cell_size,
+                 arrival_radius=default_arrival_radius):
+    """Leg index, cross-track and along-track error in metres of every sample."""
+    x, y, legs = project_track(lon, lat, plan_lon, plan_lat)
+
+    if len(legs[0]) > grid_leg_threshold:
+        nearest, nearest_distance = LegGrid(legs, cell_size).nearest_legs(x, y)
+    else:
+        nearest, nearest_distance = nearest_legs_brute_force(x, y, legs)
+    leg = sequential_legs(x, y, time, legs, nearest, nearest_distance, arrival_radius, min_duration) if sequential else nearest
+
+    x0, y0, x1, y1 = (values[leg] for values in legs)
+    dx, dy = x1 - x0, y1 - y0
+    length = np.hypot(dx, dy)
+    rx, ry = x - x0, y - y0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        along = np.where(length > 0, (rx * dx + ry * dy) / length, np.hypot(rx, ry))
+        # Positive to starboard, the cross product is positive to port
+        cross = np.where(length > 0, (rx * dy - ry * dx) / length, 0.0)
+    return leg, cross, along
+
+def along_track_error(along, length):
+    """Distance before the start (negative) or past the end (positive) of the leg, zero on the leg."""
+    return along - np.clip(along, 0.0, length)
+
+def leg_overshoots(lon, lat, plan_lon, plan_lat, leg, along):
+    """How far the track went past the end of each leg, along its direction, before it started on the next leg.
+    Samples of the next leg still before its start count as well, the next leg becomes active before its waypoint."""
+    x, y, legs = project_track(lon, lat, plan_lon, plan_lat)
+    overshoots = np.zeros(len(legs[0]))
+    for index in range(len(legs[0])):
+        samples = (leg == index) | ((leg == index + 1) & (along <= 0.0))
+        if samples.any():
+            leg_along, length, _ = leg_progress(x[samples], y[samples], legs, index)
+            overshoots[index] = max(float(leg_along.max()) - length, 0.0)
+    return overshoots
+
+def leg_lengths(plan_lon, plan_lat):
+    px, py = simplify.project_local(plan_lon, plan_lat)
+    return np.hypot(np.diff(px), np.diff(py))
+
+def leg_statistics(tags, plan_lon, plan_lat, time, leg, cross, along, overshoots):
+    """Per-leg summary of cross-track error, along-track error and how much of the leg was covered."""
+    lengths = leg_lengths(plan_lon, plan_lat)
+    order = np.argsort(leg, kind="stable")
+    boundaries = np.searchsorted(leg[order], np.arange(len(lengths) + 1))
+    statistics = []
+    for index, length in enumerate(lengths):
+        samples = order[boundaries[index]:boundaries[index + 1]]
+        entry = {"leg": index, "from": tags[index], "to": tags[index + 1], "length_m": float(length), "samples": int(len(samples))}
+        if len(samples):
+            entry.update({
+                "start_time": float(time[samples].min()),
+                "end_time": float(time[samples].max()),
+                "cross_track_m": navcompare.summary(cross[samples]),
+                "along_track_min_m": float(along[samples].min()),
+                "along_track_max_m": float(along[samples].max()),
+                "along_track_error_m": navcompare.summary(along_track_error(along[samples], length)),
+                "overshoot_m": float(overshoots[index]),
+            })
+        statistics.append(entry)
+    return statistics
+
+def analyse_mission(mission_folder_path: Path, source="navp", nth_row=1, sequential=True, min_duration=default_min_duration,
+                    arrival_radius=default_arrival_radius):
+    """Cross-track and along-track report of one mission, per leg and over all samples."""
+    mission_folder_path = Path(mission_folder_path)
+    tags, plan_lon, plan_lat = plan_legs(mission_folder_path)
+    time, lon, lat = read_track(mission_folder_path, source, nth_row)
+    report = {"mission_name": mission_folder_path.name, "source": source, "legs": []}
+    if len(plan_lon) < 2 or len(time) == 0:
+        return report
+    leg, cross, along = track_errors(time, lon, lat, plan_lon, plan_lat, sequential, min_duration, arrival_radius=arrival_radius)
+    report["cross_track_m"] = navcompare.summary(cross)
+    report["along_track_error_m"] = navcompare.summary(along_track_error(along, leg_lengths(plan_lon, plan_lat)[leg]))
+    overshoots = leg_overshoots(lon, lat, plan_lon, plan_lat, leg, along)
+    report["overshoot_max_m"] = float(overshoots.max())
+    report["legs"] = leg_statistics(tags, plan_lon, plan_lat, time, leg, cross, along, overshoots)
+    return report
+
+def convert_mission(mission_folder_path: Path, output_dir=Path("."), source="navp", nth_row=1, sequential=True, min_duration=default_min_duration,
+                    arrival_radius=default_arrival_radius):
+    report = analyse_mission(mission_folder_path, source, nth_row, sequential, min_duration, arrival_radius)
+    output_filename = Path(output_dir) / f"{Path(mission_folder_path).name}_crosstrack.json"
+    with open(output_filename, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    if "cross_track_m" in report:
+        print(f"{report['mission_name']}: cross-track rms {report['cross_track_m']['rms']:.2f} m, max {report['cross_track_m']['max']:.2f} m, "
+              f"overshoot max {report['overshoot_max_m']:.2f} m over {len(report['legs'])} legs")
+    return output_filename
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cross-track and along-track error of the navigation against the mission plan.")
+    batch.add_batch_arguments(parser)
+    parser.add_argument("--source", choices=("navp", "navlab"), default="navp", help="Navigation to compare with the plan (default: navp).")
+    parser.add_argument("--nth-row", type=int, default=1, help="Use every nth navigation sample (default: 1).")
+    parser.add_argument("--nearest", action="store_true", help="Use the nearest leg for every sample, also going back to earlier legs.")
+    parser.add_argument("--arrival-radius", type=float, default=default_arrival_radius,
+                        help=f"Metres before the end of a leg where the next leg becomes active (default: {default_arrival_radius:g}).")
+    parser.add_argument("--min-duration", type=float, default=default_min_duration,
+                        help=f"Seconds a later leg must be clearly nearest before the active leg jumps ahead to it (default: {default_min_duration:g}).")
+    args = parser.parse_args(argv)
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    return batch.run_tool(parser, args, convert_mission, output_dir=args.output_dir,
+                          source=args.source, nth_row=args.nth_row, sequential=not args.nearest, min_duration=args.min_duration,
+                          arrival_radius=args.arrival_radius)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+import json
+import numpy as np
+
+# Import local module
+import stagetiming
+
+# geojsonstream.py
+# Streaming GeoJSON writer shared by the exporters. Coordinates are written straight from NumPy arrays in chunks,
+# rounded to a fixed number of decimals and without indentation, so memory stays flat for long trajectories.
+# Writes a FeatureCollection, or GeoJSONSeq (RFC 8142, one record-separator prefixed feature per line) with seq=True.
+# Joakim Skjefstad
+
+default_precision = 7 # decimals, 1e-7 degrees is about 1 cm
+default_chunk_size = 100_000 # coordinates formatted at a time
+separators = (',', ':')
+record_separator = '\x1e'
+
+def format_coordinates(coordinates, precision=default_precision):
+    """Format an (n, 2) or (n, 3) array as comma separated JSON positions, rows with NaN/inf are dropped."""
+    coordinates = np.asarray(coordinates, dtype=np.float64)
+    if coordinates.size == 0:
+        return ""
+    coordinates = coordinates[np.isfinite(coordinates).all(axis=1)]
+    return json.dumps(np.round(coordinates, precision).tolist(), separators=separators)[1:-1]
+
+def chunked(coordinates, chunk_size=default_chunk_size):
+    """Split an (n, 2) array into views of at most chunk_size rows for write_linestring."""
+    for offset in range(0, len(coordinates), chunk_size):
+        yield coordinates[offset:offset + chunk_size]
+
+def round_coordinates(value, precision=default_precision):
+    """Round every float in a (nested) coordinate list."""
+    if isinstance(value, float):
+        return round(value, precision)
+    if isinstance(value, (list, tuple)):
+        return [round_coordinates(item, precision) for item in value]
+    return value
+
+class GeoJSONWriter:
+    """Write features to a GeoJSON FeatureCollection or GeoJSONSeq file one at a time."""
+
+    def __init__(self, path, precision=default_precision, seq=False):
+        self.path = path
+        self.precision = precision
+        self.seq = seq
+        self.file = None
+        self.number_of_features = 0
+
+    def __enter__(self):
+        self.file = open(self.path, 'w')
+        if not self.seq:
+            self.file.write('{"type":"FeatureCollection","features":[')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.seq:
+            self.file.write(']}')
+        self.file.close()
+        self.file = None
+
+    def begin_feature(self):
+        if self.seq:
+            self.file.write(record_separator)
+        elif self.number_of_features > 0:
+            self.file.write(',')
+        self.number_of_features += 1
+
+    def end_feature(self):
+        if self.seq:
+            self.file.write('\n')
+
+    def write_feature(self, feature):
+        """Write a complete feature (dict or geojson object), coordinates rounded to the writer precision."""
+        feature = dict(feature)
+        geometry = feature.get("geometry")
+        if geometry is not None and "coordinates" in geometry:
+            feature["geometry"] = {**geometry, "coordinates": round_coordinates(geometry["coordinates"], self.precision)}
+        with stagetiming.stage("geojson.write") as timing:
+            text = json.dumps(feature, separators=separators)
+            self.begin_feature()
+            self.file.write(text)
+            self.end_feature()
+            timing.add(records=1, bytes=len(text))
+
+    def write_linestring(self, coordinate_chunks, properties=None):
+        """Write a LineString feature whose coordinates come from an iterable of (n, 2) arrays."""
+        self.begin_feature()
+        self.file.write('{"type":"Feature","geometry":{"type":"LineString","coordinates":[')
+        first = True
+        for chunk in coordinate_chunks:
+            # Timed per chunk, producing the chunks (reading, simplifying) is not part of this stage
+            with stagetiming.stage("geojson.write") as timing:
+                coordinates = format_coordinates(chunk, self.precision)
+                timing.add(records=len(chunk), bytes=len(coordinates))
+                if not coordinates:
+                    continue
+                self.file.write(coordinates if first else ',' + coordinates)
+                first = False
+        self.file.write(']},"properties":')
+        self.file.write(json.dumps(properties if properties is not None else {}, separators=separators))
+        self.file.write('}')
+        self.end_feature()
+
+def write_feature_collection(path, feature_collection, precision=default_precision, seq=False):
+    """Write an already built FeatureCollection compactly, feature by feature."""
+    with GeoJSONWriter(path, precision=precision, seq=seq) as writer:
+        for feature in feature_collection["features"]:
+            writer.write_feature(feature)
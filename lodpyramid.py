@@ -0,0 +1,125 @@
+import sys
+import math
+import json
+import argparse
+import numpy as np
+from pathlib import Path
+
+# Import local module
+import geojsonstream
+import simplify
+import navpos
+import navp2geojson
+import navigation2geojson
+import navlabversions
+import batch
+
+# lodpyramid.py
+# Precomputes several levels of detail of the navp and navlab trajectories of a mission for web maps.
+# Every zoom level is simplified to about one screen pixel, clients only fetch the level they display.
+# Output is <output_dir>/<source>/z<zoom>.geojson and an index.json describing all levels.
+# Joakim Skjefstad
+
+default_zooms = range(4, 19)
+metres_per_pixel_at_equator = 156543.03392 # web mercator, 256 pixel tiles, zoom 0
+
+def zoom_tolerance(zoom, latitude, pixels=1.0):
+    """Ground size in metres of `pixels` screen pixels at a web map zoom level and latitude."""
+    return pixels * metres_per_pixel_at_equator * math.cos(math.radians(latitude)) / 2 ** zoom
+
+def zoom_precision(tolerance):
+    """Decimals of a degree needed to keep rounding well below the tolerance in metres, between 5 and 7."""
+    tolerance_degrees = tolerance / 111320.0
+    return int(min(7, max(5, math.ceil(-math.log10(tolerance_degrees)) + 1)))
+
+def build_pyramid(coordinates, zooms=default_zooms, pixels=1.0):
+    """Simplify an (n, 2) lon/lat array once per zoom level. Returns {zoom: (tolerance, coordinates)}."""
+    coordinates = np.asarray(coordinates, dtype=np.float64)
+    if len(coordinates) == 0:
+        return {zoom: (0.0, coordinates) for zoom in zooms}
+    latitude = float(np.nanmean(coordinates[:, 1]))
+
+    # Start at the finest level and simplify each coarser level from the previous one. Using the difference
+    # in tolerance at every step keeps the total deviation from the full line within the level's tolerance.
+    pyramid = {}
+    level = coordinates
+    previous_tolerance = 0.0
+    for zoom in sorted(zooms, reverse=True):
+        tolerance = zoom_tolerance(zoom, latitude, pixels)
+        level = simplify.simplify_coordinates(level, tolerance - previous_tolerance)
+        previous_tolerance = tolerance
+        pyramid[zoom] = (tolerance, level)
+    return pyramid
+
+def write_pyramid(output_dir, source_name, coordinates, properties=None, zooms=default_zooms, pixels=1.0):
+    """Write one GeoJSON file per zoom level of a trajectory and return the index entries."""
+    source_dir = Path(output_dir) / source_name
+    source_dir.mkdir(parents=True, exist_ok=True)
+
+    levels = []
+    for zoom, (tolerance, level) in sorted(build_pyramid(coordinates, zooms, pixels).items()):
+        filename = f"z{zoom}.geojson"
+        with geojsonstream.GeoJSONWriter(source_dir / filename, precision=zoom_precision(tolerance) if tolerance > 0 else geojsonstream.default_precision) as writer:
+            writer.write_linestring(geojsonstream.chunked(level), properties)
+        levels.append({
+            "zoom": zoom,
+            "file": f"{source_name}/{filename}",
+            "tolerance_m": round(tolerance, 3),
+            "vertices": len(level),
+        })
+
+    bbox = None
+    if len(coordinates) > 0:
+        bbox = [float(np.nanmin(coordinates[:, 0])), float(np.nanmin(coordinates[:, 1])),
+                float(np.nanmax(coordinates[:, 0])), float(np.nanmax(coordinates[:, 1]))]
+    return {"source": source_name, "bbox": bbox, "levels": levels}
+
+def mission_pyramid(mission_folder_path: Path, output_dir, zooms=default_zooms, pixels=1.0):
+    """Build level of detail files for the navp trajectory and every navlab solution of a mission."""
+    mission_folder_path = Path(mission_folder_path)
+    sources = []
+
+    if (mission_folder_path / navpos.format_file_relative_path).exists() and (mission_folder_path / navpos.navpos_file_relative_path).exists():
+        _, coordinates, properties, _ = navp2geojson.navp_trajectory_parts(mission_folder_path)
+        sources.append(write_pyramid(output_dir, "navp", coordinates, properties, zooms, pixels))
+    else:
+        # navlab-only mission, only the navp source is left out
+        print(f"Did not find {navpos.navpos_file_relative_path} and {navpos.format_file_relative_path} in {mission_folder_path}")
+
+    try:
+        default_navlab, alternative_navlab = navigation2geojson.find_navlab_paths(mission_folder_path)
+    except FileNotFoundError as error:
+        # navp-only mission, only the navlab sources are left out
+        print(error)
+        default_navlab, alternative_navlab = None, []
+    comparisons = navlabversions.compare_navlab_versions(default_navlab, alternative_navlab, record_differences=False) if default_navlab else []
+
+    # Identical solutions share the pyramid of the first version, the others list the same files
+    for solution, versions in navlabversions.unique_solutions(comparisons).items():
+        df = navigation2geojson.navlab_trajectory(solution)
+        source = write_pyramid(output_dir, f"navlab{versions[0]}", df[['lon', 'lat']].to_numpy(), {"mission_name": mission_folder_path.name}, zooms, pixels)
+        sources.append(source)
+        sources.extend({**source, "source": f"navlab{version}"} for version in versions[1:])
+
+    index = {"mission_name": mission_folder_path.name, "sources": sources}
+    with open(Path(output_dir) / "index.json", 'w') as index_file:
+        json.dump(index, index_file, indent=2)
+    return index
+
+def convert_mission(mission_folder_path: Path, output_dir=Path("."), pixels=1.0):
+    mission_folder_path = Path(mission_folder_path)
+    lod_dir = Path(output_dir) / f"{mission_folder_path.name}_lod"
+    index = mission_pyramid(mission_folder_path, lod_dir, pixels=pixels)
+    print(f"Wrote {sum(len(source['levels']) for source in index['sources'])} levels of detail to {lod_dir}")
+    return lod_dir
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write level of detail GeoJSON files of the navp and navlab trajectories of mission-folders.")
+    batch.add_batch_arguments(parser)
+    parser.add_argument("--pixels", type=float, default=1.0, help="Allowed deviation in screen pixels at each zoom level (default: 1).")
+    args = parser.parse_args(argv)
+
+    return batch.run_tool(parser, args, convert_mission, output_dir=args.output_dir, pixels=args.pixels)
+
+if __name__ == "__main__":
+    sys.exit(main())
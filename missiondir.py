@@ -1,51 +1,94 @@
 import os
-from tkinter import Tk
-from tkinter.filedialog import askdirectory
+from pathlib import Path
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # missiondir.py
 # Supposed to help interface an AUV mission directory, work in progress.
+# Walks a mission-folder with os.scandir, sibling directories in parallel threads, and classifies every file as
+# open access or restricted access. Excluded subtrees are pruned before they are entered when only open access is needed.
 # Joakim Skjefstad
 
-def get_open_access_filepaths():
-    # Hide the root Tkinter window
-    Tk().withdraw()
-
-    # Open a dialog to select the root directory
-    root_folder = askdirectory(title="Select Root Folder")
-    if not root_folder:
-        print("No folder selected. Exiting.")
-        return []
-
-    # Directories to exclude
-    relative_exclusions = [
-        os.path.join(root_folder, "HiSASRaw"),
-        os.path.join(root_folder, "post", "HISAS"),
-        os.path.join(root_folder, "pp", "EM2040")
-    ]
-
-    keyword_exclusions = [
-        "restricted_access"
-    ]
-
-    # List to store the filtered file paths
-    filtered_files = []
-
-    # Walk through the root folder
-    for dirpath, dirnames, filenames in os.walk(root_folder):
-        # Check if the directory is in exclusions
-        if any(dirpath.startswith(exclusion) for exclusion in relative_exclusions):
-            continue
+# Directories to exclude from open access, relative to the mission-folder
+relative_exclusions = [
+    Path("HiSASRaw"),
+    Path("post", "HISAS"),
+    Path("pp", "EM2040")
+]
+
+# Directories with any of these in their name are excluded from open access
+keyword_exclusions = [
+    "restricted_access"
+]
+
+default_workers = 16 # directories listed at the same time, scandir mostly waits on (network) storage
+
+class MissionEntry(NamedTuple):
+    path: str
+    size: int
+    mtime_ns: int
+    open_access: bool
+
+def is_excluded(relative_path: Path, name):
+    return relative_path in relative_exclusions or any(keyword in name for keyword in keyword_exclusions)
+
+def scan_directory(root_folder: Path, directory: Path, open_access, include_restricted):
+    """List one directory. Returns its file entries and the subdirectories to walk as (path, open_access)."""
+    entries = []
+    subdirectories = []
+    try:
+        iterator = os.scandir(directory)
+    except OSError as error:
+        print(f"Could not read {directory}: {error}")
+        return entries, subdirectories
+
+    with iterator:
+        for entry in iterator:
+            if entry.is_symlink() and entry.is_dir():
+                # Like os.walk, symlinked directories are neither listed as files nor entered
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                child_open_access = open_access and not is_excluded(Path(entry.path).relative_to(root_folder), entry.name)
+                # Prune before entering when the subtree would not be listed anyway
+                if child_open_access or include_restricted:
+                    subdirectories.append((Path(entry.path), child_open_access))
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                stat = entry.stat(follow_symlinks=False)
+            entries.append(MissionEntry(entry.path, stat.st_size, stat.st_mtime_ns, open_access))
+    return entries, subdirectories
+
+def scan_mission(root_folder, include_restricted=True, workers=default_workers):
+    """Yield a MissionEntry for every file in the mission-folder, in no particular order.
+    With include_restricted=False only open access files are yielded and excluded subtrees are never entered."""
+    root_folder = Path(root_folder)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(scan_directory, root_folder, root_folder, True, include_restricted)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                entries, subdirectories = future.result()
+                for directory, open_access in subdirectories:
+                    pending.add(executor.submit(scan_directory, root_folder, directory, open_access, include_restricted))
+                yield from entries
+
+def build_manifests(root_folder, workers=default_workers):
+    """Open access and restricted access (all files) manifests from a single walk."""
+    open_access_entries = []
+    restricted_access_entries = []
+    for entry in scan_mission(root_folder, include_restricted=True, workers=workers):
+        restricted_access_entries.append(entry)
+        if entry.open_access:
+            open_access_entries.append(entry)
+    return open_access_entries, restricted_access_entries
+
+def select_root_folder():
+    # Imported here, only needed for the dialog
+    from tkinter import Tk
+    from tkinter.filedialog import askdirectory
 
-        # Filter out directories with keyword exclusions
-        dirnames[:] = [d for d in dirnames if not any(keyword in d for keyword in keyword_exclusions)]
-
-        # Add files in the current directory to the list
-        for file in filenames:
-            filtered_files.append(os.path.join(dirpath, file))
-
-    return filtered_files
-
-def get_restricted_access_filepaths():
     # Hide the root Tkinter window
     Tk().withdraw()
 
@@ -53,32 +96,22 @@ def get_restricted_access_filepaths():
     root_folder = askdirectory(title="Select Root Folder")
     if not root_folder:
         print("No folder selected. Exiting.")
-        return []
-
-    # Directories to exclude
-    relative_exclusions = [
-    ]
-
-    keyword_exclusions = [
-    ]
-
-    # List to store the filtered file paths
-    filtered_files = []
-
-    # Walk through the root folder
-    for dirpath, dirnames, filenames in os.walk(root_folder):
-        # Check if the directory is in exclusions
-        if any(dirpath.startswith(exclusion) for exclusion in relative_exclusions):
-            continue
-
-        # Filter out directories with keyword exclusions
-        dirnames[:] = [d for d in dirnames if not any(keyword in d for keyword in keyword_exclusions)]
-
-        # Add files in the current directory to the list
-        for file in filenames:
-            filtered_files.append(os.path.join(dirpath, file))
-
-    return filtered_files
+        return None
+    return root_folder
+
+def get_open_access_filepaths(root_folder=None):
+    if root_folder is None:
+        root_folder = select_root_folder()
+        if not root_folder:
+            return []
+    return sorted(entry.path for entry in scan_mission(root_folder, include_restricted=False))
+
+def get_restricted_access_filepaths(root_folder=None):
+    if root_folder is None:
+        root_folder = select_root_folder()
+        if not root_folder:
+            return []
+    return sorted(entry.path for entry in scan_mission(root_folder, include_restricted=True))
 
 # Example usage
 if __name__ == "__main__":
@@ -0,0 +1,197 @@
+import os
+import time
+import shutil
+import tarfile
+import zipfile
+import argparse
+import threading
+import sys
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+# Import local module
+import missiondir
+import missionmanifest
+import navpos
+
+# missionexport.py
+# Copies the open access subset of a mission-folder (missiondir exclusion rules) to a folder or a tar/zip archive.
+# Folder exports copy with several workers using copy_file_range/sendfile where available, and keep a progress
+# journal in the target so an interrupted export continues where it stopped.
+# Joakim Skjefstad
+
+progress_filename = ".missionexport.progress"
+copy_chunk_size = 64 * 1024 * 1024
+report_interval = 5.0 # seconds between throughput reports
+
+# Files written into mission-folders by these tools, never exported
+tool_files = (missionmanifest.manifest_filename, progress_filename)
+
+def is_tool_file(name):
+    """Manifest, export progress and navpos sidecar files, generated by the tools rather than logged."""
+    return name.startswith(tool_files) or navpos.is_sidecar_file(name)
+
+class ProgressReporter:
+    """Thread-safe file and byte counters, prints throughput at most every report_interval seconds."""
+
+    def __init__(self, total_files, total_bytes):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.files = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.failed = [] # paths that could not be exported
+        self.start = time.monotonic()
+        self.last_report = self.start
+        self.lock = threading.Lock()
+
+    def add(self, size, skipped=False):
+        with self.lock:
+            self.files += 1
+            if skipped:
+                self.skipped += 1
+            else:
+                self.bytes += size
+            now = time.monotonic()
+            if now - self.last_report >= report_interval:
+                self.last_report = now
+                self.report()
+
+    def fail(self, path, error):
+        """Record a file that could not be exported, for example a dangling symlink or an unreadable file."""
+        with self.lock:
+            self.failed.append(path)
+            print(f"Could not export {path}: {error}")
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        print(f"{self.files}/{self.total_files} files ({self.skipped} already done, {len(self.failed)} failed), "
+              f"{self.bytes / 1e6:.1f} MB of {self.total_bytes / 1e6:.1f} MB, {self.bytes / 1e6 / elapsed:.1f} MB/s")
+
+def copy_file_contents(source, destination):
+    """Copy file data in the kernel with copy_file_range or sendfile where available, else through user space."""
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        size = os.fstat(source_file.fileno()).st_size
+        copied = 0
+        for zero_copy in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+            if zero_copy is None:
+                continue
+            try:
+                # sendfile writes at the current position of the destination, copy_file_range takes offsets
+                destination_file.seek(copied)
+                while copied < size:
+                    if zero_copy is os.sendfile:
+                        sent = os.sendfile(destination_file.fileno(), source_file.fileno(), copied, min(copy_chunk_size, size - copied))
+                    else:
+                        sent = zero_copy(source_file.fileno(), destination_file.fileno(), min(copy_chunk_size, size - copied), copied, copied)
+                    if sent == 0:
+                        break
+                    copied += sent
+                if copied >= size:
+                    return
+            except OSError:
+                # Not supported between these filesystems, try the next method from where this one stopped
+                continue
+        source_file.seek(copied)
+        destination_file.seek(copied)
+        shutil.copyfileobj(source_file, destination_file, copy_chunk_size)
+
+def open_access_entries(root_folder, include_restricted=False):
+    """Files to export from one walk of the mission-folder, only open access unless include_restricted."""
+    return [entry for entry in missiondir.scan_mission(root_folder, include_restricted=include_restricted)
+            if (include_restricted or entry.open_access) and not is_tool_file(Path(entry.path).name)]
+
+def export_to_directory(entries, root_folder, target_dir, workers=8):
+    """Copy entries to target_dir keeping their paths relative to root_folder. Already exported files are skipped."""
+    root_folder = Path(root_folder)
+    target_dir = Path(target_dir)
+    target_dir.mkdir(parents=True, exist_ok=True)
+    progress_path = target_dir / progress_filename
+
+    # Journal of finished files, "<relative path>\t<size>\t<mtime_ns>" per line
+    done = set()
+    if progress_path.exists():
+        with open(progress_path, 'r', encoding='utf-8') as progress_file:
+            done = {line.rstrip('\n') for line in progress_file}
+
+    progress = ProgressReporter(len(entries), sum(entry.size for entry in entries))
+    journal_lock = threading.Lock()
+    with open(progress_path, 'a', encoding='utf-8') as progress_file:
+
+        def export_entry(entry):
+            relative_path = Path(entry.path).relative_to(root_folder)
+            record = f"{relative_path.as_posix()}\t{entry.size}\t{entry.mtime_ns}"
+            destination = target_dir / relative_path
+            if record in done and destination.exists() and destination.stat().st_size == entry.size:
+                progress.add(entry.size, skipped=True)
+                return
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            temporary_path = destination.with_name(destination.name + ".part")
+            try:
+                copy_file_contents(entry.path, temporary_path)
+                shutil.copystat(entry.path, temporary_path)
+                os.replace(temporary_path, destination)
+            except OSError as error:
+                # One unreadable file or dangling symlink does not stop the export, it is reported at the end
+                temporary_path.unlink(missing_ok=True)
+                progress.fail(entry.path, error)
+                return
+            with journal_lock:
+                progress_file.write(record + "\n")
+                progress_file.flush()
+            progress.add(entry.size)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # list() to raise unexpected errors here, copy errors are recorded in progress.failed
+            list(executor.map(export_entry, entries))
+
+    progress.report()
+    return progress
+
+def export_to_archive(entries, root_folder, archive_path):
+    """Write entries to a .tar, .tar.gz or .zip archive, paths relative to root_folder. Archives are written in one pass."""
+    root_folder = Path(root_folder)
+    archive_path = Path(archive_path)
+    progress = ProgressReporter(len(entries), sum(entry.size for entry in entries))
+
+    if archive_path.suffix == ".zip":
+        with zipfile.ZipFile(archive_path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for entry in entries:
+                try:
+                    archive.write(entry.path, Path(entry.path).relative_to(root_folder).as_posix())
+                except OSError as error:
+                    progress.fail(entry.path, error)
+                    continue
+                progress.add(entry.size)
+    else:
+        mode = "w:gz" if archive_path.name.endswith((".tar.gz", ".tgz")) else "w"
+        with tarfile.open(archive_path, mode) as archive:
+            for entry in entries:
+                try:
+                    archive.add(entry.path, Path(entry.path).relative_to(root_folder).as_posix(), recursive=False)
+                except OSError as error:
+                    progress.fail(entry.path, error)
+                    continue
+                progress.add(entry.size)
+
+    progress.report()
+    return progress
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the open access files of a mission-folder to a folder or a .tar/.tar.gz/.zip archive.")
+    parser.add_argument("mission", nargs="?", help="Mission-folder, opens a folder dialog if not given.")
+    parser.add_argument("target", help="Target folder, or archive file ending in .tar, .tar.gz or .zip.")
+    parser.add_argument("-j", "--workers", type=int, default=8, help="Files copied in parallel for folder exports (default: 8).")
+    parser.add_argument("--restricted", action="store_true", help="Export all files, also the restricted access ones.")
+    args = parser.parse_args()
+
+    root_folder = args.mission or missiondir.select_root_folder()
+    if root_folder:
+        entries = open_access_entries(root_folder, include_restricted=args.restricted)
+        if args.target.endswith((".tar", ".tar.gz", ".tgz", ".zip")):
+            progress = export_to_archive(entries, root_folder, args.target)
+        else:
+            progress = export_to_directory(entries, root_folder, args.target, workers=args.workers)
+        if progress.failed:
+            print(f"{len(progress.failed)} files could not be exported.")
+            sys.exit(1)
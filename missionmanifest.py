@@ -0,0 +1,199 @@
+import os
+import sqlite3
+import hashlib
+import argparse
+from pathlib import Path
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Import local module
+import missiondir
+import navpos
+
+# missionmanifest.py
+# Persistent manifest of a mission-folder in SQLite: path, size, mtime, access class and optional hash of every file.
+# A rescan only lists directories whose mtime changed, other directories reuse their stored listing, and reports
+# which files were added, removed or modified since the last scan.
+# A directory mtime changes when entries are added, removed or renamed in it, not when a file is rewritten in place,
+# use verify=True to stat every file and catch those as well.
+# Manifests are kept in the per-user cache folder, not in the mission-folder, which may be read-only and is exported.
+# Joakim Skjefstad
+
+manifest_filename = ".missionmanifest.sqlite" # suffix of manifest files, older versions kept one in the mission-folder
+hash_buffer_size = 4 * 1024 * 1024
+
+class ManifestChanges(NamedTuple):
+    added: list
+    removed: list
+    modified: list
+
+def file_sha256(path):
+    hash_func = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while (chunk := file.read(hash_buffer_size)):
+            hash_func.update(chunk)
+    return hash_func.hexdigest()
+
+def default_manifest_path(root_folder):
+    """Manifest of a mission-folder in the cache folder, named after the mission and a hash of the absolute path."""
+    root_folder = Path(os.path.abspath(root_folder))
+    path_hash = hashlib.sha256(str(root_folder).encode()).hexdigest()[:32]
+    return navpos.user_cache_dir() / "manifests" / f"{root_folder.name}_{path_hash}{manifest_filename}"
+
+class MissionManifest:
+    """Manifest of one mission-folder, stored at default_manifest_path unless given another path."""
+
+    def __init__(self, root_folder, manifest_path=None):
+        self.root_folder = Path(root_folder)
+        self.manifest_path = Path(manifest_path) if manifest_path else default_manifest_path(self.root_folder)
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.manifest_path)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER, open_access INTEGER)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, size INTEGER, mtime_ns INTEGER, open_access INTEGER, sha256 TEXT)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS files_dir ON files (dir)")
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def entries(self, open_access=None):
+        """Stored files as missiondir.MissionEntry with absolute paths, optionally only open or restricted access."""
+        query = "SELECT path, size, mtime_ns, open_access FROM files"
+        parameters = ()
+        if open_access is not None:
+            query += " WHERE open_access = ?"
+            parameters = (int(open_access),)
+        for path, size, mtime_ns, access in self.connection.execute(query + " ORDER BY path", parameters):
+            yield missiondir.MissionEntry(str(self.root_folder / path), size, mtime_ns, bool(access))
+
+    def hashes(self):
+        return dict(self.connection.execute("SELECT path, sha256 FROM files WHERE sha256 IS NOT NULL"))
+
+    def is_manifest_file(self, name):
+        return name.startswith(self.manifest_path.name)
+
+    def list_directory(self, relative_dir, open_access, known_dirs, known_files, verify):
+        """List one directory, or reuse the stored listing if its mtime is unchanged.
+        Returns (dir row, file rows, subdirectories as (relative path, open_access))."""
+        directory = self.root_folder / relative_dir
+        parent = str(Path(relative_dir).parent) if relative_dir != "." else None
+        known = known_dirs.get(relative_dir)
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError as error:
+            return self.unreadable_directory(directory, error, relative_dir, parent, open_access, known, known_files)
+        dir_row = (relative_dir, parent, mtime_ns, int(open_access))
+
+        if not verify and known is not None and known[0] == mtime_ns and known[1] == int(open_access):
+            subdirectories = [(child, bool(child_open_access)) for child, child_open_access in known[2]]
+            return dir_row, known_files.get(relative_dir, []), subdirectories
+
+        file_rows = []
+        subdirectories = []
+        try:
+            with os.scandir(directory) as iterator:
+                for entry in iterator:
+                    relative_path = os.path.normpath(os.path.join(relative_dir, entry.name))
+                    if entry.is_symlink() and entry.is_dir():
+                        # Like missiondir.scan_directory, symlinked directories are skipped
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        child_open_access = open_access and not missiondir.is_excluded(Path(relative_path), entry.name)
+                        subdirectories.append((relative_path, child_open_access))
+                        continue
+                    if relative_dir == "." and self.is_manifest_file(entry.name):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        stat = entry.stat(follow_symlinks=False)
+                    file_rows.append((relative_path, relative_dir, stat.st_size, stat.st_mtime_ns, int(open_access), None))
+        except OSError as error:
+            return self.unreadable_directory(directory, error, relative_dir, parent, open_access, known, known_files)
+        return dir_row, file_rows, subdirectories
+
+    @staticmethod
+    def unreadable_directory(directory, error, relative_dir, parent, open_access, known, known_files):
+        """Keep the stored listing of a directory that could not be read, stored without mtime so the next scan retries it."""
+        print(f"Could not read {directory}: {error}")
+        subdirectories = [(child, bool(child_open_access)) for child, child_open_access in known[2]] if known is not None else []
+        return (relative_dir, parent, None, int(open_access)), known_files.get(relative_dir, []), subdirectories
+
+    def rescan(self, hash_files=False, verify=False, workers=missiondir.default_workers):
+        """Update the manifest from disk and return the files added, removed and modified since the last scan."""
+        # Load the stored state up front, worker threads only read these dictionaries
+        known_dirs = {}
+        children = {}
+        for path, parent, mtime_ns, open_access in self.connection.execute("SELECT path, parent, mtime_ns, open_access FROM dirs"):
+            if parent is not None:
+                children.setdefault(parent, []).append((path, open_access))
+            known_dirs[path] = (mtime_ns, open_access)
+        known_dirs = {path: (mtime_ns, open_access, children.get(path, [])) for path, (mtime_ns, open_access) in known_dirs.items()}
+        known_files = {}
+        stored_files = {}
+        for row in self.connection.execute("SELECT path, dir, size, mtime_ns, open_access, sha256 FROM files"):
+            known_files.setdefault(row[1], []).append(row)
+            stored_files[row[0]] = row
+
+        dir_rows = []
+        file_rows = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {executor.submit(self.list_directory, ".", True, known_dirs, known_files, verify)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dir_row, rows, subdirectories = future.result()
+                    dir_rows.append(dir_row)
+                    for row in rows:
+                        file_rows[row[0]] = row
+                    for relative_dir, open_access in subdirectories:
+                        pending.add(executor.submit(self.list_directory, relative_dir, open_access, known_dirs, known_files, verify))
+
+        added = sorted(path for path in file_rows if path not in stored_files)
+        removed = sorted(path for path in stored_files if path not in file_rows)
+        modified = sorted(path for path, row in file_rows.items()
+                          if path in stored_files and (row[2], row[3]) != (stored_files[path][2], stored_files[path][3]))
+
+        # Keep stored hashes of unchanged files, hash new and modified ones if asked to
+        changed = set(added) | set(modified)
+        to_hash = sorted(changed) if hash_files else []
+        if hash_files:
+            to_hash += [path for path, row in file_rows.items() if path not in changed and stored_files[path][5] is None]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            new_hashes = dict(zip(to_hash, executor.map(lambda path: file_sha256(self.root_folder / path), to_hash)))
+        for path, row in file_rows.items():
+            sha256 = new_hashes.get(path, None if path in changed else stored_files[path][5])
+            file_rows[path] = row[:5] + (sha256,)
+
+        with self.connection:
+            self.connection.execute("DELETE FROM dirs")
+            self.connection.executemany("INSERT INTO dirs VALUES (?, ?, ?, ?)", dir_rows)
+            self.connection.execute("DELETE FROM files")
+            self.connection.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)", file_rows.values())
+        return ManifestChanges(added, removed, modified)
+
+def rescan_mission(root_folder, manifest_path=None, hash_files=False, verify=False):
+    with MissionManifest(root_folder, manifest_path) as manifest:
+        return manifest.rescan(hash_files=hash_files, verify=verify)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update the manifest of a mission-folder and list changed files.")
+    parser.add_argument("mission", nargs="?", help="Mission-folder, opens a folder dialog if not given.")
+    parser.add_argument("--manifest", default=None, help="Manifest file (default: in the per-user cache folder, ~/.cache/navtools/manifests).")
+    parser.add_argument("--hash", action="store_true", help="Store SHA-256 of new and modified files.")
+    parser.add_argument("--verify", action="store_true", help="Stat every file, also in directories with unchanged mtime.")
+    args = parser.parse_args()
+
+    root_folder = args.mission or missiondir.select_root_folder()
+    if root_folder:
+        changes = rescan_mission(root_folder, args.manifest, hash_files=args.hash, verify=args.verify)
+        for label, paths in zip(("Added", "Removed", "Modified"), changes):
+            for path in paths:
+                print(f"{label}: {path}")
+        print(f"{len(changes.added)} added, {len(changes.removed)} removed, {len(changes.modified)} modified.")
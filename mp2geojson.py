@@ -1,103 +1,73 @@
-import pandas as pd
-import geojson
+import os
+import sys
 from pathlib import Path
-from tkinter import Tk
-from tkinter.filedialog import askdirectory
-import re
+import argparse
+
+# Import local module
+import geojsonstream
+import simplify
+import batch
+import productcache
+import stagetiming
 
 # mp2geojson.py
 # Reads a HuginOS missionplan .mp and does its best to output a geojson-object of the path planned.
+# pandas and geojson are imported when a mission plan is first parsed, not when the module is loaded.
 # Joakim Skjefstad
 
-def create_geojson_point(row):
-    if pd.notna(row['Latitude']) and pd.notna(row['Longitude']):
-        return geojson.Point((row['Longitude'], row['Latitude']))
-    return None
-
-def dmm_to_decimal(degrees, minutes, direction):
-    decimal = degrees + (minutes / 60)
-    if direction in ['S', 'W']:
-        decimal = -decimal
-    return decimal
-
-# Function to check if a string matches the Degrees:Minutes.decimalminutesDirection format
-def is_valid_dmm(value):
-    # Regular expression to match the format Degrees:Minutes.decimalminutesDirection
-    pattern = r"^\d{1,3}:\d{1,2}(\.\d+)?[NSWE]$"
-    return bool(re.match(pattern, value))
-
-def parse_lat_lon(lat_lon_str):
-    match = re.match(r"(\d+):(\d+\.\d+)([NSEW])", lat_lon_str)
-    if not match:
-        raise ValueError(f"Invalid latitude/longitude format: {lat_lon_str}")
-    degrees = int(match.group(1))
-    minutes = float(match.group(2))
-    direction = match.group(3)
-    return dmm_to_decimal(degrees, minutes, direction)
-
-def read_missionplan(mission_folder_path: Path):
-    mission_name = mission_folder_path.name
+# Degrees:Minutes.decimalminutesDirection, captured as degrees, minutes and direction
+dmm_pattern = r"^(\d{1,3}):(\d{1,2}(?:\.\d+)?)([NSWE])$"
+
+missionplan_columns = ["Tag", "Depth", "Alt", "DMo", "Latitude", "Longitude", "Course", "GMo", "Speed", "SMo", "Dur", "Dist", "Flags"]
+numeric_columns = ["Depth", "Alt", "Course", "Speed", "Dur", "Dist"]
+
+def dmm_series_to_decimal(values):
+    """Decimal degrees from a series of DMM strings, S and W are negative and invalid values become NaN."""
+    parts = values.astype("string").str.extract(dmm_pattern)
+    decimal = parts[0].astype(float) + parts[1].astype(float) / 60
+    return decimal.where(~parts[2].isin(['S', 'W']), -decimal)
+
+def parse_missionplan(mission_plan_path):
+    """Parse the waypoint lines of a mission plan in one pass into a dataframe with typed columns."""
+    import pandas as pd
+    with stagetiming.stage("missionplan.parse") as timing:
+        rows = []
+        with open(mission_plan_path, 'r') as file:
+            for line in file:
+                if not line.startswith(":"):  # Only waypoint lines
+                    continue
+                # Split the line based on whitespace, accounting for varying spaces
+                fields = line[1:].split()  # Remove leading ':'
+                if len(fields) >= 10:  # Ensure enough fields are present to extract data
+                    # Missing trailing fields (Dur, Dist, Flags) are set to None
+                    rows.append((fields + [None] * len(missionplan_columns))[:len(missionplan_columns)])
+
+        df = pd.DataFrame(rows, columns=missionplan_columns, dtype=object)
+        for column in numeric_columns:
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype(float)
+
+        # If a valid latitude longitude pair is found, convert it to decimal degrees, else NaN
+        df['Latitude'] = dmm_series_to_decimal(df['Latitude'])
+        df['Longitude'] = dmm_series_to_decimal(df['Longitude'])
+        timing.add(records=len(df), bytes=os.path.getsize(mission_plan_path))
+        return df
+
+def read_missionplan(mission_folder_path: Path, tolerance=None):
+    import geojson
     mission_plan_path = mission_folder_path / Path("mission.mp")
- 
-    waypoint_lines = []
-    with open(mission_plan_path, 'r') as file:
-        for line in file:
-            if line.startswith(":"):  # Extract waypoint lines
-                waypoint_lines.append(line.strip())
-
-    columns = ["Tag", "Depth", "Alt", "DMo", "Latitude", "Longitude", "Course", "GMo", "Speed", "SMo", "Dur", "Dist", "Flags"]
-    
-    df = pd.DataFrame(columns=columns)
-
-
-    for idx, line in enumerate(waypoint_lines):
-        # Split the line based on whitespace, accounting for varying spaces
-        fields = re.split(r'\s+', line[1:])  # Remove leading ':'
-        if len(fields) >= 10:  # Ensure enough fields are present to extract data
-            Tag = fields[0]
-            Depth = fields[1]
-            Alt = fields[2]
-            DMo = fields[3]
-            Latitude = fields[4]
-            Longitude = fields[5]
-            Course = fields[6]
-            GMo = fields[7]
-            Speed = fields[8]
-            SMo = fields[9]
-            Dur = fields[10]
-            Dist = fields[11]
-            try:
-                Flags = fields[12]
-            except: # No flags found, set to None
-                Flags = None
-
-            new_wp = {
-                "Tag": Tag, "Depth": Depth, "Alt": Alt, "DMo": DMo, "Latitude": Latitude, 
-                "Longitude": Longitude, "Course": Course, "GMo": GMo, "Speed": Speed, "SMo": SMo, 
-                "Dur": Dur, "Dist": Dist, "Flags": Flags
-            }
-
-            df = pd.concat([df, pd.DataFrame([new_wp])], ignore_index=True)
-
-    #print(df)
-    
-    # If a valid latitude longitude pair is found, convert it to decimal degrees
-    df['Latitude'] = df['Latitude'].apply(lambda x: parse_lat_lon(x) if is_valid_dmm(x) else None)
-    df['Longitude'] = df['Longitude'].apply(lambda x: parse_lat_lon(x) if is_valid_dmm(x) else None)
-
-    #print(df)
-
-
-    points = []
-    for _, row in df.iterrows():
-        point = create_geojson_point(row)
-        if point:
-            # Add properties like "tag"
-            point_with_properties = geojson.Feature(geometry=point, properties={"tag": row['Tag']})
-            points.append(point_with_properties)
-
-    # Create a LineString from all valid points
-    coordinates = [(row['Longitude'], row['Latitude']) for _, row in df.iterrows() if pd.notna(row['Latitude']) and pd.notna(row['Longitude'])]
+    df = parse_missionplan(mission_plan_path)
+
+    # Only waypoints with a valid position become points and vertices of the path
+    valid = df['Latitude'].notna() & df['Longitude'].notna()
+    longitudes = df['Longitude'][valid].tolist()
+    latitudes = df['Latitude'][valid].tolist()
+    tags = df['Tag'][valid].tolist()
+
+    coordinates = list(zip(longitudes, latitudes))
+    points = [geojson.Feature(geometry=geojson.Point(coordinate), properties={"tag": tag}) for coordinate, tag in zip(coordinates, tags)]
+    if tolerance is not None and coordinates:
+        # Waypoint features are all kept, only the path between them is simplified
+        coordinates = [tuple(coordinate) for coordinate in simplify.simplify_coordinates(coordinates, tolerance).tolist()]
     linestring = geojson.LineString(coordinates)
 
     # Create a FeatureCollection containing the points and the linestring
@@ -105,23 +75,28 @@ def read_missionplan(mission_folder_path: Path):
 
     return feature_collection
 
-def select_mission_folder():
-    Tk().withdraw()
-
-    mission_folder = askdirectory(title="Select missionfolder")
-    if not mission_folder:
-        print("No folder selected. Exiting.")
-        return []
-    return Path(mission_folder)
-
-if __name__ == "__main__":    
-    mission_folder_path = select_mission_folder()
-
+def convert_mission(mission_folder_path: Path, output_dir=Path("."), tolerance=None, cache_dir=None):
+    mission_folder_path = Path(mission_folder_path)
     mission_name = mission_folder_path.name
     print(f"Reading {mission_name} and making geojson-file.")
     
-    mp_geojson = read_missionplan(mission_folder_path)
-    output_filename = f"{mission_name}_missionplan.geojson"
-    with open(output_filename, 'w') as geojson_file:
-        geojson.dump(mp_geojson, geojson_file, indent=2)
-        print(f"Wrote {output_filename} successfully.")
+    output_filename = Path(output_dir) / f"{mission_name}_missionplan.geojson"
+    productcache.cached_product(
+        output_filename, "mp2geojson.missionplan", [mission_folder_path / "mission.mp"], {"tolerance": tolerance},
+        lambda destination: geojsonstream.write_feature_collection(destination, read_missionplan(mission_folder_path, tolerance=tolerance)),
+        cache_dir
+    )
+    print(f"Wrote {output_filename} successfully.")
+    return output_filename
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write the planned path of mission-folders (mission.mp) as GeoJSON.")
+    batch.add_batch_arguments(parser, cache=True)
+    parser.add_argument("--tolerance", type=float, default=None, help="Simplify the path to this many metres.")
+    args = parser.parse_args(argv)
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    return batch.run_tool(parser, args, convert_mission, output_dir=args.output_dir, tolerance=args.tolerance, cache_dir=args.cache_dir)
+
+if __name__ == "__main__":
+    sys.exit(main())
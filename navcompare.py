@@ -0,0 +1,157 @@
+import sys
+import json
+import argparse
+import numpy as np
+from pathlib import Path
+
+# Import local module
+import pynavlab
+import navpos
+import navigation2geojson
+import navlabversions
+import batch
+
+# navcompare.py
+# Compares the navp (internal, navpos.txt) solution with every navlab/postea solution of a mission.
+# navp is interpolated onto the navlab timestamps and the difference is expressed in a local east/north/up frame,
+# giving horizontal and depth difference series and summary statistics in metres.
+# Joakim Skjefstad
+
+# WGS84
+semi_major_axis = 6378137.0
+flattening = 1 / 298.257223563
+eccentricity_squared = flattening * (2 - flattening)
+
+percentiles = (50, 95, 99)
+
+def geodetic_to_ecef(lat, lon, height):
+    """WGS84 latitude/longitude in degrees and height in metres to earth-centred earth-fixed metres."""
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    sin_lat = np.sin(lat)
+    cos_lat = np.cos(lat)
+    prime_vertical_radius = semi_major_axis / np.sqrt(1 - eccentricity_squared * sin_lat**2)
+    x = (prime_vertical_radius + height) * cos_lat * np.cos(lon)
+    y = (prime_vertical_radius + height) * cos_lat * np.sin(lon)
+    z = (prime_vertical_radius * (1 - eccentricity_squared) + height) * sin_lat
+    return x, y, z
+
+def enu_difference(lat, lon, depth, reference_lat, reference_lon, reference_depth):
+    """East, north, up of each position relative to the reference position at the same index, in metres."""
+    x, y, z = geodetic_to_ecef(lat, lon, -depth)
+    reference_x, reference_y, reference_z = geodetic_to_ecef(reference_lat, reference_lon, -reference_depth)
+    dx, dy, dz = x - reference_x, y - reference_y, z - reference_z
+
+    # Rotate the ECEF difference into the local frame at each reference position
+    lat0 = np.radians(reference_lat)
+    lon0 = np.radians(reference_lon)
+    sin_lat, cos_lat = np.sin(lat0), np.cos(lat0)
+    sin_lon, cos_lon = np.sin(lon0), np.cos(lon0)
+    east = -sin_lon * dx + cos_lon * dy
+    north = -sin_lat * cos_lon * dx - sin_lat * sin_lon * dy + cos_lat * dz
+    up = cos_lat * cos_lon * dx + cos_lat * sin_lon * dy + sin_lat * dz
+    return east, north, up
+
+def summary(values):
+    """RMS, mean, max and percentiles of a difference series, NaN ignored."""
+    values = np.asarray(values, dtype=np.float64)
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return {"count": 0}
+    statistics = {
+        "count": int(len(values)),
+        "rms": float(np.sqrt(np.mean(values**2))),
+        "mean": float(np.mean(values)),
+        "max": float(np.max(np.abs(values))),
+    }
+    for percentile, value in zip(percentiles, np.percentile(np.abs(values), percentiles)):
+        statistics[f"p{percentile}"] = float(value)
+    return statistics
+
+def read_navp_solution(mission_folder_path: Path, depth_channel=navpos.depth_channel):
+    """navp time, lat, lon and depth (NaN if the depth channel is not logged), sorted by time without duplicates."""
+    reader = navpos.NavposReader(mission_folder_path)
+    channels = list(navpos.position_channels)
+    if depth_channel and depth_channel in reader.schema:
+        channels.append(depth_channel)
+    navp_df = reader.read(channels)
+
+    time = navp_df[navpos.time_channel].to_numpy(dtype=np.float64)
+    time, unique = np.unique(time, return_index=True)
+    lat = navp_df[navpos.latitude_channel].to_numpy(dtype=np.float64)[unique]
+    lon = navp_df[navpos.longitude_channel].to_numpy(dtype=np.float64)[unique]
+    depth = navp_df[depth_channel].to_numpy(dtype=np.float64)[unique] if len(channels) == 4 else np.full(len(time), np.nan)
+    return time, lat, lon, depth
+
+def compare_solution(navp_solution, navlab_path, nth_row=1):
+    """Difference series of navp minus navlab on the navlab timestamps that navp covers."""
+    navp_time, navp_lat, navp_lon, navp_depth = navp_solution
+    records = pynavlab.read_navlab_smooth_to_array(navlab_path, nth_row=nth_row)
+    if len(navp_time) == 0 or len(records) == 0:
+        empty = np.empty(0)
+        return {"time": empty, "horizontal": empty, "east": empty, "north": empty, "depth": empty}
+
+    first, last = pynavlab.time_window_indices(records, navp_time[0], navp_time[-1])
+    records = records[first:last]
+    time = np.asarray(records["timestamp"])
+
+    # Interpolate navp onto the common (navlab) time base
+    lat = np.interp(time, navp_time, navp_lat)
+    lon = np.interp(time, navp_time, navp_lon)
+    depth = np.interp(time, navp_time, navp_depth)
+
+    navlab_depth = np.asarray(records["depth"])
+    east, north, _ = enu_difference(lat, lon, np.nan_to_num(depth), np.asarray(records["lat"]), np.asarray(records["lon"]), navlab_depth)
+    return {
+        "time": time,
+        "horizontal": np.hypot(east, north),
+        "east": east,
+        "north": north,
+        "depth": depth - navlab_depth,
+    }
+
+def compare_mission(mission_folder_path: Path, nth_row=1, depth_channel=navpos.depth_channel):
+    """Summary statistics of navp against every unique navlab solution of a mission."""
+    mission_folder_path = Path(mission_folder_path)
+    navp_solution = read_navp_solution(mission_folder_path, depth_channel)
+
+    default_navlab, alternative_navlab = navigation2geojson.find_navlab_paths(mission_folder_path)
+    comparisons = navlabversions.compare_navlab_versions(default_navlab, alternative_navlab, record_differences=False)
+
+    report = {"mission_name": mission_folder_path.name, "solutions": []}
+    for solution, versions in navlabversions.unique_solutions(comparisons).items():
+        series = compare_solution(navp_solution, solution, nth_row)
+        report["solutions"].append({
+            "versions": versions,
+            "path": str(solution),
+            "start_time": float(series["time"][0]) if len(series["time"]) else None,
+            "end_time": float(series["time"][-1]) if len(series["time"]) else None,
+            "horizontal_m": summary(series["horizontal"]),
+            "east_m": summary(series["east"]),
+            "north_m": summary(series["north"]),
+            "depth_m": summary(series["depth"]),
+        })
+    return report
+
+def convert_mission(mission_folder_path: Path, output_dir=Path("."), nth_row=1):
+    report = compare_mission(mission_folder_path, nth_row)
+    output_filename = Path(output_dir) / f"{Path(mission_folder_path).name}_navigation_comparison.json"
+    with open(output_filename, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    for solution in report["solutions"]:
+        horizontal = solution["horizontal_m"]
+        if horizontal["count"]:
+            print(f"navp vs {', '.join(solution['versions'])}: horizontal rms {horizontal['rms']:.2f} m, max {horizontal['max']:.2f} m")
+    return output_filename
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the navp solution with every navlab solution of mission-folders.")
+    batch.add_batch_arguments(parser)
+    parser.add_argument("--nth-row", type=int, default=1, help="Compare on every nth navlab record (default: 1).")
+    args = parser.parse_args(argv)
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    return batch.run_tool(parser, args, convert_mission, output_dir=args.output_dir, nth_row=args.nth_row)
+
+if __name__ == "__main__":
+    sys.exit(main())
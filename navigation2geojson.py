@@ -1,13 +1,19 @@
-import pandas as pd
-import json
+import sys
+import numpy as np
+import argparse
 from pathlib import Path
-from tkinter import Tk
-from tkinter.filedialog import askdirectory
 import re
 import hashlib
+import shutil
 
 # Import local module
 import pynavlab
+import navpos
+import geojsonstream
+import simplify
+import batch
+import productcache
+import navlabversions
 
 # navigation2geojson.py
 # Trying to convert all navigation solutions for comparison. Work in progress.
@@ -27,74 +33,77 @@ def are_files_identical(file1, file2):
     checksum2 = compute_checksum(file2)
     return checksum1 == checksum2
 
-def find_navlab_versions(mission_folder_path: Path):
-    default_navlab_path = mission_folder_path / Path(r"post\\navlab_smooth.bin")
+def find_navlab_paths(mission_folder_path: Path):
+    """Default post/navlab_smooth.bin and the postea/NN/Smoothing/PosteaSmooth-0000.bin solutions of a mission."""
+    default_navlab_path = Path(mission_folder_path) / Path("post", "navlab_smooth.bin")
     if default_navlab_path.exists():
         print("Found default navlab_smooth.bin")
     else:
-        print("Did not find default navlab_smooth.bin, exiting")
-        exit(-1)
+        # Raise instead of exit(), so a batch run carries on with the next mission
+        raise FileNotFoundError(f"Did not find default navlab_smooth.bin in {mission_folder_path}")
 
-    postea_search_path = mission_folder_path / Path(r"postea")
+    postea_search_path = Path(mission_folder_path) / Path(r"postea")
 
     pattern = re.compile(r"\d\d")
 
     alternative_navlab_solutions = [
-        dir_path / Path(r"Smoothing\\PosteaSmooth-0000.bin")
-        for dir_path in postea_search_path.iterdir()
+        dir_path / Path("Smoothing", "PosteaSmooth-0000.bin")
+        for dir_path in sorted(postea_search_path.iterdir())
         if dir_path.is_dir() and pattern.fullmatch(dir_path.name)
-    ]
-
-    #print("Alternative solutions: ", alternative_navlab_solutions)
-
-    for idx, alt_solution_path in enumerate(alternative_navlab_solutions):
-        #print("Alternative solution found:", alt_solution_path)
-        if default_navlab_path.exists() and alt_solution_path.exists():
-            version = alt_solution_path.parent.parent.name if alt_solution_path.parent and alt_solution_path.parent.parent else None
-            if are_files_identical(default_navlab_path, alt_solution_path):
-                print("Default navlab identical to", version)
-            else:
-                print("Default navlab different from", version)
-        else:
-            print("One or both files do not exist.")
+    ] if postea_search_path.is_dir() else []
 
     return default_navlab_path, alternative_navlab_solutions
-    
 
+def print_navlab_comparisons(comparisons, alternative_navlab_solutions):
+    for alt_solution_path in alternative_navlab_solutions:
+        if not alt_solution_path.exists():
+            print("Solution does not exist:", alt_solution_path)
+    for comparison in comparisons:
+        if comparison.version == "default":
+            continue
+        if comparison.identical_to == "default":
+            print("Default navlab identical to", comparison.version)
+        elif comparison.identical_to:
+            print(f"Default navlab different from {comparison.version}, identical to {comparison.identical_to}")
+        elif comparison.max_position_delta is None:
+            print("Default navlab different from", comparison.version)
+        else:
+            span = "" if comparison.start_offset is None else \
+                f", starts {comparison.start_offset:+.3f} s and ends {comparison.end_offset:+.3f} s relative to default"
+            print(f"Default navlab different from {comparison.version}{span}, first difference in the common time span at {comparison.first_difference_time}, "
+                  f"max position difference {comparison.max_position_delta:.3f} m, max depth difference {comparison.max_depth_delta:.3f} m")
+
+def find_navlab_versions(mission_folder_path: Path):
+    default_navlab_path, alternative_navlab_solutions = find_navlab_paths(mission_folder_path)
+    comparisons = navlabversions.compare_navlab_versions(default_navlab_path, alternative_navlab_solutions)
+    print_navlab_comparisons(comparisons, alternative_navlab_solutions)
+    return default_navlab_path, alternative_navlab_solutions
 
-def navlab_trajectory(navlab_file_path):
+def navlab_trajectory(navlab_file_path, tolerance=None):
     n=10 # Select only every 10th row, should result in 10 Hz (100 per second in this file)
+    if tolerance is not None:
+        # Simplified from every row, so the result stays within tolerance of the full resolution track
+        n=1
     df = pynavlab.read_navlab_smooth_to_dataframe(navlab_file_path, nth_row=n, filter_columns=["timestamp", "lat", "lon",  "depth"])
+    if tolerance is not None:
+        # Keep only the rows needed to stay within tolerance metres of the full path
+        df = df.iloc[simplify.simplify_indices(df['lon'], df['lat'], tolerance)].reset_index(drop=True)
     return df
 
-def navp_trajectory(mission_folder_path: Path):
-    format_file_path = mission_folder_path / Path(r"cp\data\format.txt")
-    navpos_file_path = mission_folder_path / Path(r"cp\data\navpos.txt")
-
-    # Parse format.txt to find relevant columns for NAV_LATITUDE and NAV_LONGITUDE
-    columns_mapping = {}
-    with open(format_file_path, 'r') as f:
-        for line in f:
-            parts = line.strip().split(':')
-            #print(parts)
-            if len(parts) == 2 and 'NAVIGATION_SYSTEM_DATA    NAV_LATITUDE' in parts[1]:
-                columns_mapping['NAV_LATITUDE'] = int(parts[0].strip())
-                
-            if len(parts) == 2 and 'NAVIGATION_SYSTEM_DATA    NAV_LONGITUDE' in parts[1]:
-                columns_mapping['NAV_LONGITUDE'] = int(parts[0].strip())
-
-    # Read navpos.txt into a DataFrame
-    navpos_df = pd.read_csv(
-        navpos_file_path,
-        sep=r'\s+',
-        header=None,
-        usecols=[columns_mapping['NAV_LATITUDE'] - 1, columns_mapping['NAV_LONGITUDE'] -1],  # Adjust to 0-based indexing
-        names=['NAV_LATITUDE', 'NAV_LONGITUDE']
-    )
+def navp_coordinates(mission_folder_path: Path, tolerance=None):
+    """(n, 2) lon/lat array of the navp positions, optionally simplified to tolerance metres."""
+    # Read NAV_LATITUDE and NAV_LONGITUDE from navpos.txt, columns found through format.txt
+    navpos_arrays = navpos.NavposReader(mission_folder_path).read_arrays([navpos.latitude_channel, navpos.longitude_channel])
 
-    # Create a GeoJSON LineString from NAV_LATITUDE and NAV_LONGITUDE, selecting only every n rows
+    # LineString coordinates from NAV_LATITUDE and NAV_LONGITUDE, selecting only every n rows
     n=1
-    coordinates = navpos_df[['NAV_LONGITUDE', 'NAV_LATITUDE']].iloc[::n].values.tolist()
+    coordinates = np.column_stack((navpos_arrays[navpos.longitude_channel], navpos_arrays[navpos.latitude_channel])).astype(np.float64)[::n]
+    if tolerance is not None:
+        coordinates = simplify.simplify_coordinates(coordinates, tolerance)
+    return coordinates
+
+def navp_trajectory(mission_folder_path: Path, tolerance=None):
+    coordinates = navp_coordinates(mission_folder_path, tolerance).tolist()
 
     #every_nth_row_coordinates = coordinates
 
@@ -114,16 +123,35 @@ def navp_trajectory(mission_folder_path: Path):
 
     return geojson_line
 
+def navp_to_geojson_file(mission_folder_path: Path, geojson_path, tolerance=None, precision=geojsonstream.default_precision, seq=False):
+    """Stream the navp trajectory to a GeoJSON LineString file in chunks, without building the coordinate list."""
+    coordinates = navp_coordinates(mission_folder_path, tolerance)
+    with geojsonstream.GeoJSONWriter(geojson_path, precision=precision, seq=seq) as writer:
+        writer.write_linestring(geojsonstream.chunked(coordinates))
 
 def get_data_from_navlab(navlab_path, save_to_csv=False):
-    df = navlab_trajectory(navlab_path)
-    #print(df.head())
     version = navlab_path.parent.parent.name if navlab_path.parent and navlab_path.parent.parent else None
     if save_to_csv:
-        df.to_csv(f"navlab{version}.csv", index=False)
+        # Streamed block by block from the file, not written from the dataframe below
+        pynavlab.write_navlab_smooth_csv(navlab_path, f"navlab{version}.csv", nth_row=10, filter_columns=["timestamp", "lat", "lon",  "depth"])
         print(f"Wrote navlab{version}.csv")
+    df = navlab_trajectory(navlab_path)
+    #print(df.head())
     return df
 
+def navlab_stride(n, tolerance):
+    return 1 if tolerance is not None else n
+
+def navlab_to_geojson_file(navlab_path, geojson_path, n=10, tolerance=None, precision=geojsonstream.default_precision, seq=False):
+    """Stream a navlab solution to a GeoJSON LineString file block by block, optionally simplified to tolerance metres.
+    With a tolerance n is ignored and every record is simplified."""
+    blocks = pynavlab.iter_navlab_smooth(navlab_path, filter_columns=["lon", "lat"], nth_row=navlab_stride(n, tolerance), as_dataframe=False)
+    coordinate_chunks = (np.column_stack((block["lon"], block["lat"])) for block in blocks)
+    if tolerance is not None:
+        coordinate_chunks = simplify.simplify_chunks(coordinate_chunks, tolerance)
+    with geojsonstream.GeoJSONWriter(geojson_path, precision=precision, seq=seq) as writer:
+        writer.write_linestring(coordinate_chunks)
+
 def navigation_to_geojson(df):
     n=1 # Select only every n rows
     coordinates = df[['lon', 'lat']].iloc[::n].values.tolist()
@@ -145,27 +173,56 @@ def navigation_to_geojson(df):
     }
     return geojson_line
 
-def select_mission_folder():
-    Tk().withdraw()
-
-    mission_folder = askdirectory(title="Select missionfolder")
-    if not mission_folder:
-        print("No folder selected. Exiting.")
-        return []
-    return mission_folder
-
-if __name__ == "__main__":    
-    mission_folder_path = select_mission_folder()
-
-    navp_trajectory_geojson = navp_trajectory(mission_folder_path)
-    with open("navp_auv_path.geojson", 'w') as geojson_file:
-        json.dump(navp_trajectory_geojson, geojson_file, indent=2)
-
-    default_navlab, alternative_navlab = find_navlab_versions(mission_folder_path)
-    for solution in alternative_navlab:
-        version = solution.parent.parent.name if solution.parent and solution.parent.parent else None
+def convert_mission(mission_folder_path: Path, output_dir=Path("."), tolerance=None, cache_dir=None):
+    """Write the navp trajectory and every postea navlab solution of a mission-folder as GeoJSON files in output_dir."""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    mission_folder_path = Path(mission_folder_path)
+    productcache.cached_product(
+        output_dir / "navp_auv_path.geojson", "navigation2geojson.navp",
+        [mission_folder_path / navpos.format_file_relative_path, mission_folder_path / navpos.navpos_file_relative_path],
+        {"tolerance": tolerance},
+        lambda destination: navp_to_geojson_file(mission_folder_path, destination, tolerance=tolerance),
+        cache_dir
+    )
 
-        df = get_data_from_navlab(solution)
-        nav_json = navigation_to_geojson(df)
-        with open(f"navlab{version}.geojson", 'w') as geojson_file:
-            json.dump(nav_json, geojson_file, indent=2)
+    default_navlab, alternative_navlab = find_navlab_paths(mission_folder_path)
+    # Only which solutions are identical matters here, with a cache their hashes are also the product keys' input hashes
+    if cache_dir is None:
+        comparisons = navlabversions.compare_navlab_versions(default_navlab, alternative_navlab, record_differences=False)
+    else:
+        with productcache.ProductCache(cache_dir) as cache:
+            comparisons = navlabversions.compare_navlab_versions(default_navlab, alternative_navlab, record_differences=False, product_cache=cache)
+    print_navlab_comparisons(comparisons, alternative_navlab)
+
+    # Identical postea solutions are converted once, the others get a copy of the file
+    for solution, versions in navlabversions.unique_solutions(comparisons).items():
+        versions = [version for version in versions if version != "default"]
+        if not versions:
+            continue
+        first_output = output_dir / f"navlab{versions[0]}.geojson"
+        productcache.cached_product(
+            first_output, "navigation2geojson.navlab", [solution], {"n": navlab_stride(10, tolerance), "tolerance": tolerance},
+            lambda destination: navlab_to_geojson_file(solution, destination, tolerance=tolerance),
+            cache_dir
+        )
+        for version in versions[1:]:
+            shutil.copyfile(first_output, output_dir / f"navlab{version}.geojson")
+    return output_dir
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write the navp and navlab navigation solutions of mission-folders as GeoJSON.")
+    batch.add_batch_arguments(parser, cache=True)
+    parser.add_argument("--tolerance", type=float, default=None, help="Simplify the trajectories to this many metres.")
+    args = parser.parse_args(argv)
+
+    # One subfolder per mission, the file names are the same for every mission. A selected mission writes straight to output_dir
+    function = convert_mission_to_subfolder if args.missions else convert_mission
+    return batch.run_tool(parser, args, function, output_dir=args.output_dir, tolerance=args.tolerance, cache_dir=args.cache_dir)
+
+def convert_mission_to_subfolder(mission_folder_path: Path, output_dir=Path("."), tolerance=None, cache_dir=None):
+    return convert_mission(mission_folder_path, Path(output_dir) / Path(mission_folder_path).name, tolerance, cache_dir)
+
+if __name__ == "__main__":
+    sys.exit(main())
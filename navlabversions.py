@@ -0,0 +1,221 @@
+import os
+import hashlib
+import numpy as np
+from pathlib import Path
+from typing import NamedTuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+# Import local module
+import pynavlab
+import stagetiming
+
+# navlabversions.py
+# Compares the default post/navlab_smooth.bin with the postea/NN solutions of a mission.
+# Each file is hashed at most once, and only when size and a sampled pre-check cannot tell files apart.
+# Different solutions are compared on their common timestamps, identical solutions are grouped so they are converted once.
+# Joakim Skjefstad
+
+hash_buffer_size = 4 * 1024 * 1024 # hashlib releases the GIL for large updates, so threads hash in parallel
+sample_block_size = 64 * 1024
+number_of_samples = 16 # blocks read evenly spread over the file in the pre-check
+record_block_size = 1_000_000 # records compared at a time
+earth_radius = 6371008.8 # metres
+
+class VersionComparison(NamedTuple):
+    path: Path
+    version: str
+    identical_to: Optional[str] # version of the first identical solution, None if unique
+    first_difference_time: Optional[float] # first timestamp in the common time span where the records differ from default
+    start_offset: Optional[float] # seconds the solution starts after default, negative if before
+    end_offset: Optional[float] # seconds the solution ends after default
+    max_position_delta: Optional[float] # metres, horizontal, over the common time span
+    max_depth_delta: Optional[float] # metres
+
+def navlab_version_name(navlab_path: Path, default_navlab_path: Path):
+    """'default' for post/navlab_smooth.bin, else the postea/NN folder name."""
+    if navlab_path == default_navlab_path:
+        return "default"
+    return navlab_path.parent.parent.name if navlab_path.parent and navlab_path.parent.parent else str(navlab_path)
+
+class FileDigests:
+    """Hashes and samples files at most once per size and mtime. Given a productcache.ProductCache, full hashes
+    are shared with its index, so files hashed by an earlier run or for a cached product are not read again."""
+
+    def __init__(self, workers=None, product_cache=None):
+        self.workers = workers
+        self.product_cache = product_cache
+        self.hashes = {}
+        self.samples = {}
+
+    @staticmethod
+    def key(path):
+        stat = os.stat(path)
+        return (str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns)
+
+    def sample(self, path):
+        """Hash of the first, last and evenly spread blocks of a file, cheap pre-check before a full hash."""
+        key = self.key(path)
+        if key not in self.samples:
+            size = key[1]
+            hash_func = hashlib.sha256()
+            with stagetiming.stage("navlab_versions.sample") as timing, open(path, 'rb') as file:
+                offsets = np.linspace(0, max(size - sample_block_size, 0), number_of_samples).astype(np.int64)
+                for offset in np.unique(offsets):
+                    file.seek(int(offset))
+                    block = file.read(sample_block_size)
+                    hash_func.update(block)
+                    timing.add(bytes=len(block))
+            self.samples[key] = hash_func.hexdigest()
+        return self.samples[key]
+
+    def full_hash(self, path):
+        key = self.key(path)
+        if key not in self.hashes:
+            hash_func = hashlib.sha256()
+            with stagetiming.stage("navlab_versions.hash") as timing, open(path, 'rb') as file:
+                while (chunk := file.read(hash_buffer_size)):
+                    hash_func.update(chunk)
+                timing.add(records=key[1] // pynavlab.bytes_per_row, bytes=key[1])
+            self.hashes[key] = hash_func.hexdigest()
+        return self.hashes[key]
+
+    def full_hashes(self, paths):
+        """Hash several files in parallel threads, each file once."""
+        hashes = {}
+        if self.product_cache is not None:
+            # The index connection belongs to this thread, look up and record hashes here
+            for path in paths:
+                sha256 = self.product_cache.known_hash(path)
+                if sha256 is not None:
+                    hashes[path] = sha256
+        to_hash = [path for path in paths if path not in hashes]
+        stats = {path: os.stat(path) for path in to_hash}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            hashes.update(zip(to_hash, executor.map(self.full_hash, to_hash)))
+        if self.product_cache is not None:
+            for path in to_hash:
+                self.product_cache.record_hash(path, stats[path], hashes[path])
+        return hashes
+
+    def identical_groups(self, paths):
+        """Group paths whose content is identical. Sizes and samples split groups before anything is fully hashed."""
+        by_size = {}
+        for path in paths:
+            by_size.setdefault(os.path.getsize(path), []).append(path)
+
+        candidates = []
+        for same_size in by_size.values():
+            if len(same_size) == 1:
+                candidates.append(same_size)
+                continue
+            by_sample = {}
+            for path in same_size:
+                by_sample.setdefault(self.sample(path), []).append(path)
+            candidates.extend(by_sample.values())
+
+        to_hash = [path for group in candidates if len(group) > 1 for path in group]
+        hashes = self.full_hashes(to_hash) if to_hash else {}
+
+        groups = []
+        for group in candidates:
+            if len(group) == 1:
+                groups.append(group)
+                continue
+            by_hash = {}
+            for path in group:
+                by_hash.setdefault(hashes[path], []).append(path)
+            groups.extend(by_hash.values())
+        return groups
+
+def record_difference(navlab_path, other_navlab_path):
+    """Compare two navlab files on the timestamps they share. Returns the first differing timestamp, the start and end
+    offsets of the other file in seconds and the max horizontal and depth difference in metres over the common time span."""
+    records = pynavlab.read_navlab_smooth_to_array(navlab_path)
+    other_records = pynavlab.read_navlab_smooth_to_array(other_navlab_path)
+    if len(records) == 0 or len(other_records) == 0:
+        return None, None, None, 0.0, 0.0
+    time = np.asarray(records["timestamp"])
+    other_time = np.asarray(other_records["timestamp"])
+    start_offset = float(other_time[0] - time[0])
+    end_offset = float(other_time[-1] - time[-1])
+
+    # Records of each file inside the time span of the other, a shifted start or end is reported by the offsets
+    first, last = np.searchsorted(time, other_time[0], side="left"), np.searchsorted(time, other_time[-1], side="right")
+    other_first, other_last = np.searchsorted(other_time, time[0], side="left"), np.searchsorted(other_time, time[-1], side="right")
+
+    first_difference_time = None
+    # Timestamps of the other file that this file does not have
+    other_common_time = other_time[other_first:other_last]
+    missing = np.flatnonzero(~np.isin(other_common_time, time[first:last]))
+    if len(missing) > 0:
+        first_difference_time = float(other_common_time[missing[0]])
+
+    max_position_delta = 0.0
+    max_depth_delta = 0.0
+    other_columns = None # lat, lon and depth of the other file, only read when timestamps do not match
+    number_of_doubles = len(pynavlab.NavlabRow._fields)
+    for offset in range(first, last, record_block_size):
+        end = min(offset + record_block_size, last)
+        block = np.asarray(records[offset:end])
+        block_time = block["timestamp"]
+        other_index = np.minimum(np.searchsorted(other_time, block_time), len(other_time) - 1)
+        matched = other_time[other_index] == block_time
+        other_block = np.asarray(other_records[other_index])
+
+        # Bitwise, so NaN fields compare equal when both files hold the same bytes
+        differing = (block.view('<u8').reshape(-1, number_of_doubles) != other_block.view('<u8').reshape(-1, number_of_doubles)).any(axis=1)
+        differing_rows = np.flatnonzero(differing | ~matched)
+        if len(differing_rows) > 0 and (first_difference_time is None or block_time[differing_rows[0]] < first_difference_time):
+            first_difference_time = float(block_time[differing_rows[0]])
+
+        # Timestamps only this file has are compared with the other file interpolated to them
+        other_lat, other_lon, other_depth = other_block["lat"], other_block["lon"], other_block["depth"]
+        if not matched.all():
+            if other_columns is None:
+                other_columns = [np.asarray(other_records[field]) for field in ("lat", "lon", "depth")]
+            unmatched = ~matched
+            for values, column in zip((other_lat, other_lon, other_depth), other_columns):
+                values[unmatched] = np.interp(block_time[unmatched], other_time, column)
+
+        north = np.radians(other_lat - block["lat"]) * earth_radius
+        east = np.radians(other_lon - block["lon"]) * earth_radius * np.cos(np.radians(block["lat"]))
+        if len(block) > 0:
+            max_position_delta = max(max_position_delta, float(np.nanmax(np.hypot(north, east))))
+            max_depth_delta = max(max_depth_delta, float(np.nanmax(np.abs(other_depth - block["depth"]))))
+    return first_difference_time, start_offset, end_offset, max_position_delta, max_depth_delta
+
+def compare_navlab_versions(default_navlab_path: Path, alternative_navlab_paths, workers=None, record_differences=True, product_cache=None):
+    """Compare every solution with the default. Returns a VersionComparison per existing solution, default first.
+    With record_differences=False only identical solutions are found, the difference fields are left None."""
+    paths = [path for path in [default_navlab_path] + list(alternative_navlab_paths) if path.exists()]
+    digests = FileDigests(workers, product_cache)
+
+    identical_to = {}
+    for group in digests.identical_groups(paths):
+        # Keep the order of paths, the first solution of a group represents it
+        group = sorted(group, key=paths.index)
+        for path in group[1:]:
+            identical_to[path] = group[0]
+
+    comparisons = []
+    for path in paths:
+        version = navlab_version_name(path, default_navlab_path)
+        representative = identical_to.get(path)
+        identical_version = navlab_version_name(representative, default_navlab_path) if representative else None
+
+        first_difference_time = start_offset = end_offset = max_position_delta = max_depth_delta = None
+        if record_differences and path != default_navlab_path and default_navlab_path.exists() and representative != default_navlab_path:
+            with stagetiming.stage("navlab_versions.compare") as timing:
+                first_difference_time, start_offset, end_offset, max_position_delta, max_depth_delta = record_difference(default_navlab_path, path)
+                timing.add(records=os.path.getsize(path) // pynavlab.bytes_per_row, bytes=os.path.getsize(path) + os.path.getsize(default_navlab_path))
+        comparisons.append(VersionComparison(path, version, identical_version, first_difference_time, start_offset, end_offset, max_position_delta, max_depth_delta))
+    return comparisons
+
+def unique_solutions(comparisons):
+    """Map each unique solution path to the versions sharing its content, so each is converted only once."""
+    representatives = {}
+    by_version = {comparison.version: comparison.path for comparison in comparisons}
+    for comparison in comparisons:
+        representative = by_version[comparison.identical_to] if comparison.identical_to else comparison.path
+        representatives.setdefault(representative, []).append(comparison.version)
+    return representatives
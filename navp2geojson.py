@@ -1,56 +1,42 @@
-import pandas as pd
-import json
+import sys
+import argparse
+import numpy as np
+from datetime import datetime, timezone
 from pathlib import Path
-from tkinter import Tk
-from tkinter.filedialog import askdirectory
+
+# Import local module
+import navpos
+import geojsonstream
+import simplify
+import batch
+import productcache
 
 # navp2geojson.py
 # Read navp (internal) navigation solution and make a geojson-output.
 # Joakim Skjefstad
 
-def navp_trajectory(mission_folder_path: Path, nth_row=1):
+def navp_trajectory_parts(mission_folder_path: Path, nth_row=1, tolerance=None):
+    """Start point feature, (n, 2) lon/lat array of every nth_row position, trajectory properties and end point feature.
+    With a tolerance in metres nth_row is ignored and the full track is simplified with Douglas-Peucker."""
     mission_name = mission_folder_path.name
-    format_file_path = mission_folder_path / Path(r"cp\data\format.txt")
-    navpos_file_path = mission_folder_path / Path(r"cp\data\navpos.txt")
-
-    # Parse format.txt to find relevant columns for NAV_LATITUDE and NAV_LONGITUDE
-    columns_mapping = {}
-    with open(format_file_path, 'r') as f:
-        for line in f:
-            parts = line.strip().split(':')
-            #print(parts)
-
-            #if len(parts) == 2 and 'Time' in parts[1]:
-            #    columns_mapping['Time'] = int(parts[0].strip())
-            #    print("Time col:", columns_mapping['Time'])
-            # Hardcode time col...
-            columns_mapping['Time'] = 1
-
-            if len(parts) == 2 and 'NAVIGATION_SYSTEM_DATA    NAV_LATITUDE' in parts[1]:
-                columns_mapping['NAV_LATITUDE'] = int(parts[0].strip())
-                
-            if len(parts) == 2 and 'NAVIGATION_SYSTEM_DATA    NAV_LONGITUDE' in parts[1]:
-                columns_mapping['NAV_LONGITUDE'] = int(parts[0].strip())
-
-    # Read navpos.txt into a DataFrame
-    navpos_df = pd.read_csv(
-        navpos_file_path,
-        sep=r'\s+',
-        header=None,
-        usecols=[columns_mapping['Time'] - 1,columns_mapping['NAV_LATITUDE'] - 1, columns_mapping['NAV_LONGITUDE'] -1],  # Adjust to 0-based indexing
-        names=['Time', 'NAV_LATITUDE', 'NAV_LONGITUDE']
-    )
+    # Read Time, NAV_LATITUDE and NAV_LONGITUDE from navpos.txt, columns found through format.txt
+    # NumPy arrays straight from the reader, no dataframe needed for the export
+    navpos_arrays = navpos.NavposReader(mission_folder_path).read_arrays(navpos.position_channels)
+    positions = np.column_stack((navpos_arrays[navpos.longitude_channel], navpos_arrays[navpos.latitude_channel])).astype(np.float64)
 
-    print(navpos_df)
+    print(f"Read {len(positions)} navp positions of {mission_name}")
 
-    mission_starttime = pd.to_datetime(navpos_df['Time'].iloc[0], unit='s')
-    mission_endtime = pd.to_datetime(navpos_df['Time'].iloc[-1], unit='s')
+    mission_starttime = datetime.fromtimestamp(float(navpos_arrays[navpos.time_channel][0]), tz=timezone.utc)
+    mission_endtime = datetime.fromtimestamp(float(navpos_arrays[navpos.time_channel][-1]), tz=timezone.utc)
 
-    mission_startcoordinates = navpos_df[['NAV_LONGITUDE', 'NAV_LATITUDE']].iloc[0].values.tolist()
-    mission_endcoordinates = navpos_df[['NAV_LONGITUDE', 'NAV_LATITUDE']].iloc[-1].values.tolist()
+    mission_startcoordinates = positions[0].tolist()
+    mission_endcoordinates = positions[-1].tolist()
 
-    # Create a GeoJSON LineString from NAV_LATITUDE and NAV_LONGITUDE, selecting only every nth_row rows
-    coordinates = navpos_df[['NAV_LONGITUDE', 'NAV_LATITUDE']].iloc[::nth_row].values.tolist()
+    # LineString coordinates from NAV_LATITUDE and NAV_LONGITUDE, selecting only every nth_row rows
+    coordinates = positions[::nth_row]
+    if tolerance is not None:
+        # Simplified from every position, so the line stays within tolerance of the full resolution track
+        coordinates = simplify.simplify_coordinates(positions, tolerance)
 
     geojson_startpoint = {
         "type": "Point",
@@ -79,17 +65,24 @@ def navp_trajectory(mission_folder_path: Path, nth_row=1):
                     }
     }
 
+    trajectory_properties = {
+        "mission_name": mission_name,
+        "mission_starttime_utc" : mission_starttime.strftime('%Y-%m-%d %H:%M:%S'),
+        "mission_endtime_utc" : mission_endtime.strftime('%Y-%m-%d %H:%M:%S')
+    }
+
+    return startpoint_feature, coordinates, trajectory_properties, endpoint_feature
+
+def navp_trajectory(mission_folder_path: Path, nth_row=1, tolerance=None):
+    startpoint_feature, coordinates, trajectory_properties, endpoint_feature = navp_trajectory_parts(mission_folder_path, nth_row, tolerance)
+
     trajectory_feature = {
                 "type": "Feature",
                 "geometry": {
                     "type": "LineString",
-                    "coordinates": coordinates
+                    "coordinates": coordinates.tolist()
                 },
-                "properties": {
-                    "mission_name": mission_name,
-                    "mission_starttime_utc" : mission_starttime.strftime('%Y-%m-%d %H:%M:%S'),
-                    "mission_endtime_utc" : mission_endtime.strftime('%Y-%m-%d %H:%M:%S')
-                }
+                "properties": trajectory_properties
             }
 
     feature_collection = {
@@ -99,25 +92,39 @@ def navp_trajectory(mission_folder_path: Path, nth_row=1):
 
     return feature_collection
 
-def select_mission_folder():
-    Tk().withdraw()
-
-    mission_folder = askdirectory(title="Select missionfolder")
-    if not mission_folder:
-        print("No folder selected. Exiting.")
-        return []
-    return Path(mission_folder)
-
-if __name__ == "__main__":    
-    mission_folder_path = select_mission_folder()
+def write_navp_geojson(mission_folder_path: Path, output_filename, nth_row=1, tolerance=None, precision=geojsonstream.default_precision, seq=False):
+    """Write the navp trajectory straight from the position arrays, without building the coordinate list."""
+    startpoint_feature, coordinates, trajectory_properties, endpoint_feature = navp_trajectory_parts(mission_folder_path, nth_row, tolerance)
+    with geojsonstream.GeoJSONWriter(output_filename, precision=precision, seq=seq) as writer:
+        writer.write_feature(startpoint_feature)
+        writer.write_linestring(geojsonstream.chunked(coordinates), trajectory_properties)
+        writer.write_feature(endpoint_feature)
 
+def convert_mission(mission_folder_path: Path, output_dir=Path("."), nth_row=5, tolerance=None, cache_dir=None):
+    mission_folder_path = Path(mission_folder_path)
     mission_name = mission_folder_path.name
     print(mission_name)
     print(mission_folder_path)
 
+    output_filename = Path(output_dir) / f"{mission_name}_internal_navigation.geojson"
+    productcache.cached_product(
+        output_filename, "navp2geojson.navp",
+        [mission_folder_path / navpos.format_file_relative_path, mission_folder_path / navpos.navpos_file_relative_path],
+        {"nth_row": nth_row, "tolerance": tolerance},
+        lambda destination: write_navp_geojson(mission_folder_path, destination, nth_row=nth_row, tolerance=tolerance),
+        cache_dir
+    )
+    return output_filename
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write the navp (internal) navigation solution of mission-folders as GeoJSON.")
+    batch.add_batch_arguments(parser, cache=True)
+    parser.add_argument("--nth-row", type=int, default=5, help="Keep every nth position (default: 5), ignored with --tolerance.")
+    parser.add_argument("--tolerance", type=float, default=None, help="Simplify the trajectory to this many metres.")
+    args = parser.parse_args(argv)
+    args.output_dir.mkdir(parents=True, exist_ok=True)
 
-    navp_trajectory_geojson = navp_trajectory(mission_folder_path, nth_row=5)
+    return batch.run_tool(parser, args, convert_mission, output_dir=args.output_dir, nth_row=args.nth_row, tolerance=args.tolerance, cache_dir=args.cache_dir)
 
-    output_filename = f"{mission_name}_internal_navigation.geojson"
-    with open(output_filename, 'w') as geojson_file:
-        json.dump(navp_trajectory_geojson, geojson_file, indent=2)
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,259 @@
+import os
+import json
+import re
+import uuid
+import hashlib
+import numpy as np
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+# Import local module
+import stagetiming
+
+# navpos.py
+# Reads the navp (internal) navigation solution from cp/data/navpos.txt, using cp/data/format.txt for the columns.
+# Parsed columns are kept in a binary sidecar so the text is only tokenized once. Sidecars live in a per-user cache
+# folder (NAVTOOLS_CACHE_DIR, else ~/.cache/navtools/navpos or %LOCALAPPDATA%), never inside the mission-folder.
+# Joakim Skjefstad
+
+format_file_relative_path = Path("cp", "data", "format.txt")
+navpos_file_relative_path = Path("cp", "data", "navpos.txt")
+
+sidecar_suffix = ".columns.npz"
+temporary_suffix = ".tmp" # the sidecar is written to a temporary file first and renamed into place
+cache_dir_environment_variable = "NAVTOOLS_CACHE_DIR"
+signature_block_size = 1024 * 1024 # bytes hashed from start and end of navpos.txt to detect changes
+
+identifier_pattern = re.compile(r"[A-Za-z_]\w*")
+
+# Position channels, group-qualified since a field name can be logged under several groups
+time_channel = "Time"
+latitude_channel = "NAVIGATION_SYSTEM_DATA NAV_LATITUDE"
+longitude_channel = "NAVIGATION_SYSTEM_DATA NAV_LONGITUDE"
+depth_channel = "NAVIGATION_SYSTEM_DATA NAV_DEPTH"
+position_channels = [time_channel, latitude_channel, longitude_channel]
+
+class NavposChannel(NamedTuple):
+    column: int # 1-based column in navpos.txt
+    group: str
+    field: Optional[str]
+    description: str
+
+    @property
+    def name(self):
+        return self.field if self.field else self.group
+
+    @property
+    def qualified_name(self):
+        return f"{self.group} {self.field}" if self.field else self.group
+
+class NavposSchema:
+    """Every channel listed in format.txt, looked up by field name, group, or "GROUP FIELD"."""
+
+    def __init__(self, channels):
+        self.channels = sorted(channels, key=lambda channel: channel.column)
+        self.by_qualified_name = {}
+        self.by_name = {}
+        for channel in self.channels:
+            self.by_qualified_name.setdefault(channel.qualified_name, channel)
+            self.by_name.setdefault(channel.name, []).append(channel)
+
+        # Time is always the first column
+        if 'Time' not in self.by_name:
+            time_channel = NavposChannel(1, 'Time', None, '')
+            self.by_qualified_name['Time'] = time_channel
+            self.by_name['Time'] = [time_channel]
+
+    @classmethod
+    def from_format_file(cls, format_file_path):
+        """Parse format.txt, lines are "<column>: <GROUP>    <FIELD> [description]"."""
+        channels = []
+        with open(format_file_path, 'r') as f:
+            for line in f:
+                column, separator, rest = line.strip().partition(':')
+                if not separator or not column.strip().isdigit():
+                    continue
+                names = rest.split()
+                if not names:
+                    continue
+                group = names[0]
+                field = names[1] if len(names) > 1 and identifier_pattern.fullmatch(names[1]) else None
+                description = " ".join(names[2:] if field else names[1:])
+                channels.append(NavposChannel(int(column.strip()), group, field, description))
+        return cls(channels)
+
+    def lookup(self, name):
+        """Return the channel for a field name, a group without fields, or "GROUP FIELD" / "GROUP.FIELD"."""
+        qualified_name = " ".join(name.replace('.', ' ').split())
+        if qualified_name in self.by_qualified_name:
+            return self.by_qualified_name[qualified_name]
+        matches = self.by_name.get(name, [])
+        if len(matches) == 1:
+            return matches[0]
+        if len(matches) > 1:
+            groups = ", ".join(channel.group for channel in matches)
+            raise KeyError(f"Channel {name} is in several groups ({groups}), use \"GROUP {name}\"")
+        raise KeyError(f"Channel not found in format.txt: {name}")
+
+    def column(self, name):
+        return self.lookup(name).column
+
+    def groups(self):
+        return list(dict.fromkeys(channel.group for channel in self.channels))
+
+    def __contains__(self, name):
+        try:
+            self.lookup(name)
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        return iter(self.channels)
+
+    def __len__(self):
+        return len(self.channels)
+
+def read_navpos_format(format_file_path):
+    """Parse format.txt once into a mapping of channel name to 1-based column number in navpos.txt."""
+    schema = NavposSchema.from_format_file(format_file_path)
+    columns = {name: channel.column for name, channel in schema.by_qualified_name.items()}
+    # Like NavposSchema.lookup, a field name in several groups is only found as "GROUP FIELD"
+    columns.update({name: channels[0].column for name, channels in schema.by_name.items() if len(channels) == 1})
+    return columns
+
+def file_signature(file_path):
+    """Size, mtime and a hash of the first and last block of a file, cheap enough to check on every run."""
+    stat = os.stat(file_path)
+    hash_func = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        hash_func.update(file.read(signature_block_size))
+        if stat.st_size > signature_block_size:
+            file.seek(max(stat.st_size - signature_block_size, signature_block_size))
+            hash_func.update(file.read(signature_block_size))
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": hash_func.hexdigest()}
+
+def user_cache_dir():
+    """The platform's per-user cache folder for the tools, navtools in ~/.cache or %LOCALAPPDATA%."""
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or Path.home() / "AppData" / "Local"
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "navtools"
+
+def default_cache_dir():
+    """Folder for navpos sidecars, NAVTOOLS_CACHE_DIR or the platform's per-user cache folder."""
+    if os.environ.get(cache_dir_environment_variable):
+        return Path(os.environ[cache_dir_environment_variable])
+    return user_cache_dir() / "navpos"
+
+def sidecar_path_for(navpos_file_path, cache_dir=None):
+    """Sidecar of a navpos.txt in the cache folder, named after the mission and a hash of the absolute path."""
+    navpos_file_path = Path(os.path.abspath(navpos_file_path))
+    key = hashlib.sha256(str(navpos_file_path).encode()).hexdigest()[:32]
+    mission_name = navpos_file_path.parents[2].name if len(navpos_file_path.parents) > 2 else ""
+    return Path(cache_dir or default_cache_dir()) / f"{mission_name}_{key}{sidecar_suffix}"
+
+def is_sidecar_file(name):
+    """True for sidecar caches and their temporary files, earlier versions wrote them next to navpos.txt."""
+    return sidecar_suffix in name and (name.endswith(sidecar_suffix) or name.endswith(temporary_suffix))
+
+def load_sidecar(sidecar_path, signature, columns):
+    """Return {column: array} from the sidecar if it matches the signature and holds all columns, else None."""
+    try:
+        with np.load(sidecar_path) as sidecar:
+            if json.loads(str(sidecar["signature"])) != signature:
+                return None
+            keys = [f"column_{column}" for column in columns]
+            if not all(key in sidecar.files for key in keys):
+                return None
+            return {column: sidecar[key] for column, key in zip(columns, keys)}
+    except Exception:
+        # Missing, truncated or corrupt (BadZipFile, EOFError, ...), a cache miss and rewritten after parsing
+        return None
+
+def save_sidecar(sidecar_path, signature, arrays):
+    """Write the parsed columns to the sidecar, merging with columns already cached for the same file."""
+    arrays = {f"column_{column}": values for column, values in arrays.items() if values.dtype.kind in "biuf"}
+    try:
+        with np.load(sidecar_path) as sidecar:
+            if json.loads(str(sidecar["signature"])) == signature:
+                arrays = {**{key: sidecar[key] for key in sidecar.files if key != "signature"}, **arrays}
+    except Exception:
+        # Nothing usable to merge with, the sidecar is replaced
+        pass
+
+    # Unique per writer, so tools caching the same mission at once never write into each other's file
+    temporary_path = sidecar_path.with_name(f"{sidecar_path.name}.{os.getpid()}.{uuid.uuid4().hex}{temporary_suffix}")
+    try:
+        sidecar_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(temporary_path, 'wb') as file:
+            np.savez(file, signature=np.array(json.dumps(signature)), **arrays)
+        os.replace(temporary_path, sidecar_path)
+    except OSError as error:
+        # The sidecar is only an optimization
+        print(f"Could not write navpos cache {sidecar_path}: {error}")
+        try:
+            os.remove(temporary_path)
+        except OSError:
+            pass
+
+def read_navpos_columns(navpos_file_path, columns, use_cache=True):
+    """Read the given 1-based columns of navpos.txt, from the sidecar when it is up to date."""
+    columns = list(dict.fromkeys(columns))
+    sidecar_path = sidecar_path_for(navpos_file_path)
+    signature = file_signature(navpos_file_path)
+
+    if use_cache:
+        with stagetiming.stage("navpos.sidecar") as timing:
+            cached = load_sidecar(sidecar_path, signature, columns)
+            if cached is not None:
+                timing.add(records=len(next(iter(cached.values()), [])), bytes=sum(values.nbytes for values in cached.values()))
+                return cached
+
+    # Only needed when the sidecar is missing or out of date
+    import pandas as pd
+
+    with stagetiming.stage("navpos.parse") as timing:
+        # sep=r'\s+' is handled by the C parser, only the requested columns are converted
+        navpos_df = pd.read_csv(
+            navpos_file_path,
+            sep=r'\s+',
+            engine='c',
+            header=None,
+            usecols=[column - 1 for column in columns],  # Adjust to 0-based indexing
+        )
+        arrays = {column: navpos_df[column - 1].to_numpy() for column in columns}
+        timing.add(records=len(navpos_df), bytes=os.path.getsize(navpos_file_path))
+
+    if use_cache:
+        with stagetiming.stage("navpos.sidecar_write"):
+            save_sidecar(sidecar_path, signature, arrays)
+    return arrays
+
+class NavposReader:
+    """Reads channels of one mission's navpos.txt on demand, keeping parsed columns so consumers share one parse."""
+
+    def __init__(self, mission_folder_path: Path, use_cache=True):
+        self.mission_folder_path = Path(mission_folder_path)
+        self.navpos_file_path = self.mission_folder_path / navpos_file_relative_path
+        self.schema = NavposSchema.from_format_file(self.mission_folder_path / format_file_relative_path)
+        self.use_cache = use_cache
+        self.arrays = {}
+
+    def read_arrays(self, channels):
+        """NumPy array per requested channel, missing columns are read together in a single pass."""
+        columns = [self.schema.column(channel) for channel in channels]
+        missing = [column for column in dict.fromkeys(columns) if column not in self.arrays]
+        if missing:
+            self.arrays.update(read_navpos_columns(self.navpos_file_path, missing, use_cache=self.use_cache))
+        return {channel: self.arrays[column] for channel, column in zip(channels, columns)}
+
+    def read(self, channels):
+        """Dataframe with one column per requested channel."""
+        import pandas as pd
+        return pd.DataFrame(self.read_arrays(channels), columns=list(channels))
+
+def read_navpos(mission_folder_path: Path, channels, use_cache=True):
+    """Read the named channels of navpos.txt into a dataframe with one column per channel."""
+    return NavposReader(mission_folder_path, use_cache=use_cache).read(channels)
@@ -0,0 +1,259 @@
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import numpy as np
+from pathlib import Path
+from collections import deque
+
+# Import local module
+import navpos
+import geojsonstream
+
+# navposlive.py
+# Follows navpos.txt while the vehicle (or a replay) appends to it and publishes the new positions as GeoJSON.
+# Only the bytes appended since the last poll are read and parsed, in a worker thread, with the columns from format.txt
+# like navp2geojson. The latest positions are kept in a bounded ring buffer, new clients first get that trail and then
+# every update. Updates are GeoJSONSeq (RFC 8142) records over TCP, LineString features of at most update_size new
+# positions. Every client has its own bounded queue, a client that falls behind is disconnected instead of holding
+# back the others.
+# Joakim Skjefstad
+
+channels = navpos.position_channels
+default_port = 8765
+default_buffer_size = 100_000 # positions kept for new clients
+default_interval = 0.2 # seconds between polls of navpos.txt
+default_update_size = 10_000 # positions per update feature at most
+default_client_queue_size = 100 # updates waiting to be sent before a client is dropped as too slow
+read_size = 1024 * 1024 # bytes read from navpos.txt per poll, a backlog is caught up over several polls
+
+class NavposTail:
+    """Incremental reader of a growing navpos.txt, each poll() parses only the complete lines appended since the last."""
+
+    def __init__(self, mission_folder_path: Path, channels=channels):
+        mission_folder_path = Path(mission_folder_path)
+        self.navpos_file_path = mission_folder_path / navpos.navpos_file_relative_path
+        schema = navpos.NavposSchema.from_format_file(mission_folder_path / navpos.format_file_relative_path)
+        self.channels = list(channels)
+        # 0-based field index of every channel in a navpos.txt line
+        self.fields = [schema.column(channel) - 1 for channel in self.channels]
+        self.offset = 0
+        self.partial_line = b""
+        self.pending = False
+
+    def poll(self, max_bytes=read_size):
+        """Arrays of the channels in the complete lines appended since the last poll, reading at most max_bytes.
+        pending is True while more appended data is waiting to be read."""
+        lines = []
+        try:
+            with open(self.navpos_file_path, 'rb') as navpos_file:
+                size = navpos_file.seek(0, 2)
+                if size < self.offset:
+                    # Truncated or replaced, start over from the beginning
+                    self.offset = 0
+                    self.partial_line = b""
+                navpos_file.seek(self.offset)
+                data = navpos_file.read(max_bytes)
+                self.offset += len(data)
+                self.pending = self.offset < size
+                # A line is only parsed once its newline is written
+                complete, _, self.partial_line = (self.partial_line + data).rpartition(b"\n")
+                if complete:
+                    lines = complete.split(b"\n")
+        except FileNotFoundError:
+            self.pending = False
+        return self.parse(lines)
+
+    def parse(self, lines):
+        rows = []
+        last_field = max(self.fields)
+        for line in lines:
+            fields = line.split()
+            if len(fields) <= last_field:
+                continue
+            try:
+                rows.append([float(fields[field]) for field in self.fields])
+            except ValueError:
+                continue
+        values = np.array(rows, dtype=np.float64).reshape(-1, len(self.fields))
+        return {channel: values[:, index] for index, channel in enumerate(self.channels)}
+
+def update_feature(mission_name, time, coordinates, precision=geojsonstream.default_precision):
+    """LineString feature of the positions in one update, with their time span."""
+    return {
+        "type": "Feature",
+        "geometry": {"type": "LineString", "coordinates": geojsonstream.round_coordinates(coordinates.tolist(), precision)},
+        "properties": {"mission_name": mission_name, "start_time": float(time[0]), "end_time": float(time[-1]), "positions": int(len(time))},
+    }
+
+def geojson_record(feature):
+    return (geojsonstream.record_separator + json.dumps(feature, separators=geojsonstream.separators) + "\n").encode()
+
+class NavposFollower:
+    """Polls a mission's navpos.txt, keeps the latest positions in a ring buffer and sends updates to connected clients."""
+
+    def __init__(self, mission_folder_path: Path, buffer_size=default_buffer_size, interval=default_interval,
+                 update_size=default_update_size, client_queue_size=default_client_queue_size):
+        self.mission_folder_path = Path(mission_folder_path)
+        self.mission_name = self.mission_folder_path.name
+        self.interval = interval
+        self.update_size = max(1, min(update_size, buffer_size))
+        self.client_queue_size = client_queue_size
+        self.positions = deque(maxlen=buffer_size) # (time, lon, lat)
+        self.clients = {} # writer: queue of records to send
+        self.tail = None
+
+    async def wait_for_files(self):
+        format_file_path = self.mission_folder_path / navpos.format_file_relative_path
+        while not format_file_path.exists():
+            await asyncio.sleep(self.interval)
+        self.tail = NavposTail(self.mission_folder_path)
+
+    def add_positions(self, arrays):
+        """Add polled positions to the ring buffer, returns their update features of at most update_size positions."""
+        time = arrays[navpos.time_channel]
+        coordinates = np.column_stack((arrays[navpos.longitude_channel], arrays[navpos.latitude_channel]))
+        features = []
+        for offset in range(0, len(time), self.update_size):
+            update_time = time[offset:offset + self.update_size]
+            update_coordinates = coordinates[offset:offset + self.update_size]
+            # Start the update at the last position already sent, so consecutive updates join into one line
+            if self.positions:
+                _, lon, lat = self.positions[-1]
+                joined = np.vstack(([lon, lat], update_coordinates))
+            else:
+                joined = update_coordinates
+            self.positions.extend(zip(update_time.tolist(), update_coordinates[:, 0].tolist(), update_coordinates[:, 1].tolist()))
+            features.append(update_feature(self.mission_name, update_time, joined))
+        return features
+
+    def poll(self):
+        """Read new positions into the ring buffer and return their update features, empty if nothing was appended."""
+        return self.add_positions(self.tail.poll())
+
+    def trail_feature(self):
+        """Everything in the ring buffer as one feature, sent to clients when they connect."""
+        if not self.positions:
+            return None
+        trail = np.array(self.positions, dtype=np.float64)
+        return update_feature(self.mission_name, trail[:, 0], trail[:, 1:])
+
+    def broadcast(self, feature):
+        if not self.clients:
+            return
+        record = geojson_record(feature)
+        for writer, queue in list(self.clients.items()):
+            try:
+                queue.put_nowait(record)
+            except asyncio.QueueFull:
+                # Too slow to keep up, it gets the trail again when it reconnects
+                print(f"Dropping client {writer.get_extra_info('peername')}, {queue.qsize()} updates behind")
+                self.clients.pop(writer, None)
+                writer.transport.abort()
+
+    async def send_updates(self, writer, queue):
+        try:
+            while True:
+                writer.write(await queue.get())
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+
+    async def handle_client(self, reader, writer):
+        queue = asyncio.Queue(maxsize=self.client_queue_size)
+        trail = self.trail_feature()
+        if trail is not None:
+            queue.put_nowait(geojson_record(trail))
+        self.clients[writer] = queue
+        sender = asyncio.create_task(self.send_updates(writer, queue))
+        try:
+            # Clients only listen, wait until they disconnect
+            await reader.read()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            sender.cancel()
+            self.clients.pop(writer, None)
+            writer.close()
+
+    async def follow(self, on_update=None):
+        """Poll forever, passing each update feature to on_update and to every connected client."""
+        await self.wait_for_files()
+        while True:
+            # Reading and parsing run in a worker thread, the event loop keeps serving clients meanwhile
+            arrays = await asyncio.to_thread(self.tail.poll)
+            for feature in self.add_positions(arrays):
+                if on_update is not None:
+                    on_update(feature)
+                self.broadcast(feature)
+                # Let the client tasks send before the next update is queued
+                await asyncio.sleep(0)
+            if not self.tail.pending:
+                await asyncio.sleep(self.interval)
+
+    async def serve(self, host="127.0.0.1", port=default_port, on_update=None):
+        server = await asyncio.start_server(self.handle_client, host, port)
+        print(f"Following {self.mission_folder_path}, GeoJSONSeq updates on {host}:{port}")
+        async with server:
+            await self.follow(on_update)
+
+def replay(source_mission_folder_path: Path, target_mission_folder_path: Path, speed=10.0, batch_seconds=0.1):
+    """Append the source navpos.txt to the target at speed times real time, for testing the follower."""
+    source_mission_folder_path = Path(source_mission_folder_path)
+    target_mission_folder_path = Path(target_mission_folder_path)
+    target_data_dir = target_mission_folder_path / navpos.navpos_file_relative_path.parent
+    target_data_dir.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(source_mission_folder_path / navpos.format_file_relative_path, target_mission_folder_path / navpos.format_file_relative_path)
+    time_field = navpos.NavposSchema.from_format_file(source_mission_folder_path / navpos.format_file_relative_path).column(navpos.time_channel) - 1
+
+    start = time.monotonic()
+    first_time = None
+    with open(source_mission_folder_path / navpos.navpos_file_relative_path, 'rb') as source, \
+         open(target_mission_folder_path / navpos.navpos_file_relative_path, 'wb') as target:
+        pending = []
+        for line in source:
+            fields = line.split()
+            try:
+                line_time = float(fields[time_field])
+            except (IndexError, ValueError):
+                continue
+            if first_time is None:
+                first_time = line_time
+            pending.append(line)
+            due = start + (line_time - first_time) / speed
+            # Write in batches of about batch_seconds, like a logger flushing its buffer
+            if due - time.monotonic() > batch_seconds:
+                target.writelines(pending)
+                target.flush()
+                pending = []
+                time.sleep(max(0.0, due - time.monotonic()))
+        target.writelines(pending)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Follow a growing navpos.txt and publish GeoJSON updates, or replay a mission into one.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    follow_parser = subparsers.add_parser("follow", help="Publish new navpos.txt positions as GeoJSONSeq over TCP.")
+    follow_parser.add_argument("mission", help="Mission-folder being logged to.")
+    follow_parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1).")
+    follow_parser.add_argument("--port", type=int, default=default_port, help=f"Port to listen on (default: {default_port}).")
+    follow_parser.add_argument("--buffer", type=int, default=default_buffer_size, help=f"Positions kept for new clients (default: {default_buffer_size}).")
+    follow_parser.add_argument("--interval", type=float, default=default_interval, help=f"Seconds between polls (default: {default_interval}).")
+    follow_parser.add_argument("--print", action="store_true", help="Also print a line per update.")
+    replay_parser = subparsers.add_parser("replay", help="Append a mission's navpos.txt to another mission-folder at accelerated speed.")
+    replay_parser.add_argument("source", help="Mission-folder to replay.")
+    replay_parser.add_argument("target", help="Mission-folder to write cp/data/format.txt and navpos.txt to.")
+    replay_parser.add_argument("--speed", type=float, default=10.0, help="Times real time (default: 10).")
+    args = parser.parse_args()
+
+    if args.command == "follow":
+        follower = NavposFollower(args.mission, args.buffer, args.interval)
+        on_update = None
+        if args.print:
+            on_update = lambda feature: print(f"{feature['properties']['positions']} positions up to {feature['properties']['end_time']:.3f}")
+        try:
+            asyncio.run(follower.serve(args.host, args.port, on_update))
+        except KeyboardInterrupt:
+            pass
+    else:
+        replay(args.source, args.target, args.speed)
@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+from pathlib import Path
+
+# productcache.py
+# Persistent cache of derived mission products (csv, geojson), keyed by the hashes of the input files,
+# the parameters used and the tool version. Unchanged missions are not converted again.
+# Input hashes are remembered by size and mtime, so an unchanged file is only hashed once.
+# Joakim Skjefstad
+
+tool_version = "1.0" # bump when output of any converter changes, invalidates all cached products
+default_max_bytes = 10 * 1024**3 # cache size before least recently used products are evicted
+hash_buffer_size = 1024 * 1024
+
+class ProductCache:
+    """Content-addressed product store with an SQLite index, safe to share between batch worker processes."""
+
+    def __init__(self, cache_dir, max_bytes=default_max_bytes):
+        self.cache_dir = Path(cache_dir)
+        self.objects_dir = self.cache_dir / "objects"
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(self.cache_dir / "index.sqlite", timeout=60)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS inputs (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS products (key TEXT PRIMARY KEY, size INTEGER, last_used REAL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS outputs (path TEXT PRIMARY KEY, key TEXT, size INTEGER, mtime_ns INTEGER)")
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def known_hash(self, file_path):
+        """SHA-256 of a file from the index, None unless its size and mtime are unchanged since it was hashed."""
+        path = str(Path(file_path).resolve())
+        stat = os.stat(path)
+        row = self.connection.execute("SELECT size, mtime_ns, sha256 FROM inputs WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        return None
+
+    def record_hash(self, file_path, stat, sha256):
+        """Remember the SHA-256 of a file as of stat, taken before it was hashed."""
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO inputs VALUES (?, ?, ?, ?)", (str(Path(file_path).resolve()), stat.st_size, stat.st_mtime_ns, sha256))
+
+    def file_hash(self, file_path):
+        """SHA-256 of a file, reused from the index while its size and mtime are unchanged."""
+        sha256 = self.known_hash(file_path)
+        if sha256 is not None:
+            return sha256
+
+        stat = os.stat(file_path)
+        hash_func = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            while (chunk := file.read(hash_buffer_size)):
+                hash_func.update(chunk)
+        sha256 = hash_func.hexdigest()
+        self.record_hash(file_path, stat, sha256)
+        return sha256
+
+    def product_key(self, product, inputs, parameters):
+        """Key of a product from its kind, the hashes of its input files, its parameters and the tool version."""
+        description = {
+            "tool_version": tool_version,
+            "product": product,
+            "inputs": [self.file_hash(input_path) for input_path in inputs],
+            "parameters": parameters,
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+    def object_path(self, key):
+        return self.objects_dir / key[:2] / key
+
+    def output_is_current(self, destination, key):
+        """True if destination was written from this key and has not been touched since."""
+        path = str(Path(destination).resolve())
+        row = self.connection.execute("SELECT key, size, mtime_ns FROM outputs WHERE path = ?", (path,)).fetchone()
+        if row is None or row[0] != key or not os.path.exists(path):
+            return False
+        stat = os.stat(path)
+        return row[1] == stat.st_size and row[2] == stat.st_mtime_ns
+
+    def record_output(self, destination, key):
+        path = str(Path(destination).resolve())
+        stat = os.stat(path)
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?)", (path, key, stat.st_size, stat.st_mtime_ns))
+
+    def get(self, key, destination):
+        """Copy a cached product to destination. Returns False if it is not in the cache."""
+        object_path = self.object_path(key)
+        if not object_path.exists():
+            return False
+        shutil.copyfile(object_path, destination)
+        with self.connection:
+            self.connection.execute("UPDATE products SET last_used = ? WHERE key = ?", (time.time(), key))
+        return True
+
+    def put(self, key, source_path):
+        """Store a product in the cache and evict least recently used products above max_bytes."""
+        object_path = self.object_path(key)
+        object_path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = object_path.with_name(f"{object_path.name}.{os.getpid()}.tmp")
+        shutil.copyfile(source_path, temporary_path)
+        os.replace(temporary_path, object_path)
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO products VALUES (?, ?, ?)", (key, object_path.stat().st_size, time.time()))
+        self.evict()
+
+    def evict(self):
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM products").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.connection.execute("SELECT key, size FROM products ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            self.object_path(key).unlink(missing_ok=True)
+            with self.connection:
+                self.connection.execute("DELETE FROM products WHERE key = ?", (key,))
+            total -= size
+
+def cached_product(destination, product, inputs, parameters, build, cache_dir=None, max_bytes=default_max_bytes):
+    """Write a product to destination with build(destination), unless the cache already holds it for these inputs."""
+    if cache_dir is None:
+        build(destination)
+        return destination
+
+    with ProductCache(cache_dir, max_bytes) as cache:
+        key = cache.product_key(product, inputs, parameters)
+        if cache.output_is_current(destination, key):
+            print(f"Unchanged: {destination}")
+            return destination
+        if cache.get(key, destination):
+            print(f"From cache: {destination}")
+        else:
+            build(destination)
+            cache.put(key, destination)
+        cache.record_output(destination, key)
+    return destination
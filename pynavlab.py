@@ -1,9 +1,16 @@
-import struct
-import pandas as pd
-from datetime import datetime, timezone
+import os
+import sys
+import glob
+import argparse
+import numpy as np
+from pathlib import Path
 from typing import NamedTuple
 
+# Import local module
+import stagetiming
+
 # Module used to interpret binary navlab-solution.
+# Decoding only needs NumPy, pandas is imported by the functions returning dataframes when first called.
 # Joakim Skjefstad
 
 class NavlabRow(NamedTuple):
@@ -32,41 +39,267 @@ class NavlabRow(NamedTuple):
 bytes_per_row = 168 # bytes per row, navlab_smooth.bin has 168, 21 columns
 number_of_doubles = str(round(bytes_per_row/8)) # 8 bytes per double (float), navlab_smooth.bin has 21 doubles
 
+# Structured dtype matching one navlab_smooth.bin row, one little-endian double per NavlabRow field
+navlab_dtype = np.dtype([(field, '<f8') for field in NavlabRow._fields])
+
+# Filepath to navlab_smooth.bin, every nth row. Returns a read-only strided view into a memory-mapped file.
+def read_navlab_smooth_to_array(filepath, nth_row=1):
+    """Memory-map navlab_smooth.bin as a structured array, decimated without copying."""
+    number_of_rows = os.path.getsize(filepath) // bytes_per_row
+    if number_of_rows == 0:
+        return np.empty(0, dtype=navlab_dtype)
+    records = np.memmap(filepath, dtype=navlab_dtype, mode='r', shape=(number_of_rows,))
+    return records[::nth_row]
+
+def timestamps_to_microseconds(timestamps):
+    """Convert seconds since 1970-01-01 to integer microseconds, rounded like datetime.fromtimestamp."""
+    # Split into whole and fractional seconds first and round the fraction half-to-even,
+    # this is how datetime.fromtimestamp does it, so both paths give identical microseconds
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    fraction, whole = np.modf(timestamps)
+    return np.round(fraction * 1e6).astype(np.int64) + whole.astype(np.int64) * 1_000_000
+
+def timestamps_to_datetime(timestamps):
+    """Convert seconds since 1970-01-01 to UTC datetimes, rounded to microseconds like datetime.fromtimestamp."""
+    import pandas as pd
+    return pd.to_datetime(timestamps_to_microseconds(timestamps), unit='us', utc=True)
+
+def to_epoch_seconds(value):
+    """Accept seconds since 1970-01-01, a datetime or a pandas/numpy timestamp and return seconds as float."""
+    if value is None:
+        return None
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return float(value)
+    import pandas as pd
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize('UTC')
+    return timestamp.timestamp()
+
+def records_to_dataframe(records, filter_columns):
+    """Build a dataframe of the selected columns from navlab records, 'datetime' is derived from timestamp."""
+    import pandas as pd
+    with stagetiming.stage("navlab.decode") as timing:
+        timing.add(records=len(records), bytes=len(records) * bytes_per_row)
+        # Only the selected columns are pulled out of the records, each one a strided view of the file
+        columns = {}
+        for column in filter_columns:
+            if column == "datetime":
+                # timestamp is number of seconds since 1970-01-01, convert to datetime in utc timezone
+                with stagetiming.stage("navlab.datetime"):
+                    columns[column] = timestamps_to_datetime(records["timestamp"])
+            else:
+                columns[column] = records[column]
+        return pd.DataFrame(columns, columns=filter_columns)
+
+def records_to_array(records, filter_columns):
+    """Copy the selected columns of navlab records into a compact structured array, 'datetime' as datetime64[us]."""
+    dtype = [(column, 'datetime64[us]') if column == "datetime" else (column, '<f8') for column in filter_columns]
+    with stagetiming.stage("navlab.decode") as timing:
+        timing.add(records=len(records), bytes=len(records) * bytes_per_row)
+        block = np.empty(len(records), dtype=dtype)
+        for column in filter_columns:
+            if column == "datetime":
+                with stagetiming.stage("navlab.datetime"):
+                    block[column] = timestamps_to_microseconds(records["timestamp"]).astype('datetime64[us]')
+            else:
+                block[column] = records[column]
+    return block
+
+# Headings wrap around, interpolate them along the shortest arc. Angles are in degrees like lat and lon.
+wrapped_columns = ("heading",)
+
+def bisect_timestamp(records, t, side="left"):
+    """Binary search over records ordered by timestamp, reading only O(log n) records from the file."""
+    # np.searchsorted would first copy the whole strided timestamp column, this touches one record per step
+    low, high = 0, len(records)
+    while low < high:
+        middle = (low + high) // 2
+        timestamp = records[middle]["timestamp"]
+        if timestamp < t or (side == "right" and timestamp == t):
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+def time_window_indices(records, start=None, end=None):
+    """Return the half-open index range [first, last) of records with start <= timestamp <= end."""
+    first = 0 if start is None else bisect_timestamp(records, start, side="left")
+    last = len(records) if end is None else bisect_timestamp(records, end, side="right")
+    return first, max(first, last)
+
+def slice_by_time(filepath, start, end, filter_columns=None, nth_row=1):
+    """Return the rows with start <= timestamp <= end as a dataframe, without reading the rest of the file."""
+    if filter_columns is None:
+        filter_columns = list(NavlabRow._fields)
+    records = read_navlab_smooth_to_array(filepath, nth_row=nth_row)
+    first, last = time_window_indices(records, to_epoch_seconds(start), to_epoch_seconds(end))
+    return records_to_dataframe(records[first:last], filter_columns)
+
+def at_time(filepath, t, filter_columns=None):
+    """Interpolate the navlab solution at one or more query times. Times outside the file give NaN."""
+    import pandas as pd
+    if filter_columns is None:
+        filter_columns = [field for field in NavlabRow._fields if field != "timestamp"]
+    query = np.atleast_1d(np.asarray([to_epoch_seconds(value) for value in np.atleast_1d(t)], dtype=np.float64))
+    records = read_navlab_smooth_to_array(filepath)
+
+    # Only the records bracketing the query times are read, found by bisection
+    first, last = time_window_indices(records, query.min(), query.max())
+    first, last = max(first - 1, 0), min(last + 1, len(records))
+    window = np.array(records[first:last])
+    timestamps = window["timestamp"]
+
+    result = {"timestamp": query}
+    valid = np.zeros(len(query), dtype=bool)
+    if len(window) > 0:
+        valid = (query >= timestamps[0]) & (query <= timestamps[-1])
+        upper = np.searchsorted(timestamps, query, side="right")
+        upper = np.clip(upper, 1, len(window) - 1) if len(window) > 1 else np.zeros_like(upper)
+        lower = np.maximum(upper - 1, 0)
+        span = timestamps[upper] - timestamps[lower]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fraction = np.where(span > 0, (query - timestamps[lower]) / span, 0.0)
+
+    for column in filter_columns:
+        if column == "timestamp":
+            continue
+        if column == "datetime":
+            result[column] = timestamps_to_datetime(query)
+            continue
+        values = np.full(len(query), np.nan)
+        if len(window) > 0:
+            difference = window[column][upper] - window[column][lower]
+            if column in wrapped_columns:
+                difference = (difference + 180.0) % 360.0 - 180.0
+            interpolated = window[column][lower] + fraction * difference
+            if column in wrapped_columns:
+                interpolated = interpolated % 360.0
+            values = np.where(valid, interpolated, np.nan)
+        result[column] = values
+
+    columns = ["timestamp"] + [column for column in filter_columns if column != "timestamp"]
+    return pd.DataFrame(result, columns=columns)
+
 # Filepath to navlab_smooth.bin, list of columns to output, every nth row. Returns dataframe of selected values.
 def read_navlab_smooth_to_dataframe(filepath, filter_columns, nth_row=10):
     print(f"Hang on... reading bin file, only every {nth_row} nth row")
-    nav = []
-    with open(filepath, "rb") as fp:
-        while (data_bytes := fp.read(bytes_per_row)):
-            row = NavlabRow._make(struct.unpack('<'+str(number_of_doubles)+'d', data_bytes))
-            fp.seek((nth_row-1)*bytes_per_row, 1)
-            #print_only(row)
-            # attach row to table
-            nav.append(row)
-
-    # concatenate list of rows into a table
-    nav_table = pd.DataFrame(nav)
-
-    # timestamps to datetime
-    print("Hang on... Calculating date & times and writting file")
-    # timestamp is number of seconds since 1970-01-01
-    # convert the timestamp to a datetime object (YMD HMS) in utc timezone
-    # nav_table["datetime"] = [pd.Timestamp(s, unit='s', tz=timezone.utc).floor('S') for s in nav_table["timestamp"]  ]
-    # this is a lot faster than pandas
-    nav_table["datetime"] = [datetime.fromtimestamp(s,  tz=timezone.utc)  for s in nav_table["timestamp"] ] # .replace(microsecond=0)
-
-    # select only some of the columns to save space
-    # disable ( # ) this row if you want to export all the columns
-    nav_table = nav_table[filter_columns]
-
+    records = read_navlab_smooth_to_array(filepath, nth_row=nth_row)
+    nav_table = records_to_dataframe(records, filter_columns)
     return nav_table
 
+# Filepath to navlab_smooth.bin, yields blocks of at most block_size rows so memory stays bounded for any file size.
+def iter_navlab_smooth(filepath, filter_columns=None, nth_row=1, block_size=100_000, start=None, end=None, as_dataframe=True):
+    """Iterate over navlab_smooth.bin in fixed-size blocks, optionally limited to the time window [start, end]."""
+    if filter_columns is None:
+        filter_columns = list(NavlabRow._fields)
+    start = to_epoch_seconds(start)
+    end = to_epoch_seconds(end)
+
+    records = read_navlab_smooth_to_array(filepath, nth_row=nth_row)
+    first, last = time_window_indices(records, start, end)
+    for offset in range(first, last, block_size):
+        block = records[offset:min(offset + block_size, last)]
+        if as_dataframe:
+            yield records_to_dataframe(block, filter_columns)
+        else:
+            yield records_to_array(block, filter_columns)
+
+# Stream navlab_smooth.bin to csv one block at a time.
+def write_navlab_smooth_csv(filepath, csv_path, filter_columns, nth_row=10, block_size=100_000):
+    import pandas as pd
+    with open(csv_path, 'w', newline='') as csv_file:
+        header = True
+        for block in iter_navlab_smooth(filepath, filter_columns, nth_row=nth_row, block_size=block_size):
+            with stagetiming.stage("navlab.csv") as timing:
+                position = csv_file.tell()
+                block.to_csv(csv_file, index=False, header=header)
+                timing.add(records=len(block), bytes=csv_file.tell() - position)
+            header = False
+        if header:
+            # Empty file, still write the header
+            pd.DataFrame(columns=filter_columns).to_csv(csv_file, index=False)
+
+def navlab_file_for(path):
+    """A navlab .bin file as given, or post/navlab_smooth.bin of a mission-folder."""
+    path = Path(path)
+    return path if path.is_file() else path / "post" / "navlab_smooth.bin"
+
+def csv_name_for(path):
+    """Output name without suffix, from the mission and postea version so files with the same name do not collide."""
+    path = Path(path)
+    if not path.is_file():
+        return f"{path.name}_navlab_smooth"
+    parts = Path(os.path.abspath(path)).parts
+    if len(parts) >= 5 and parts[-4] == "postea" and parts[-2] == "Smoothing":
+        # <mission>/postea/<NN>/Smoothing/PosteaSmooth-0000.bin
+        return f"{parts[-5]}_{parts[-3]}_{path.stem}"
+    if len(parts) >= 3 and parts[-2] == "post":
+        # <mission>/post/navlab_smooth.bin, named like the mission-folder itself
+        return f"{parts[-3]}_{path.stem}"
+    return f"{path.parent.resolve().name}_{path.stem}"
+
+def convert_mission(path, output_dir=Path("."), nth_row=10, filter_columns=("timestamp", "lat", "lon",  "depth"), cache_dir=None):
+    """Write navlab_smooth.bin of a mission-folder (or a .bin file) to <output_dir>/<csv_name_for(path)>.csv."""
+    # Imported here, only the command line conversion uses the product cache
+    import productcache
+    filepath = navlab_file_for(path)
+    csv_path = Path(output_dir) / f"{csv_name_for(path)}.csv"
+    productcache.cached_product(
+        csv_path, "pynavlab.csv", [filepath], {"nth_row": nth_row, "columns": list(filter_columns)},
+        lambda destination: write_navlab_smooth_csv(filepath, destination, nth_row=nth_row, filter_columns=list(filter_columns)),
+        cache_dir
+    )
+    return csv_path
+
+def unique_outputs(paths, output_dir):
+    """Inputs with one output file each. The same navlab file given twice is converted once, different files
+    with the same output name raise ValueError."""
+    by_output = {}
+    for path in paths:
+        by_output.setdefault(Path(output_dir) / f"{csv_name_for(path)}.csv", []).append(path)
+    for csv_path, inputs in by_output.items():
+        if len({os.path.abspath(navlab_file_for(path)) for path in inputs}) > 1:
+            raise ValueError(f"{', '.join(str(path) for path in inputs)} would all be written to {csv_path}")
+    return [inputs[0] for inputs in by_output.values()]
+
+def main(argv=None):
+    # Imported here, the decoding functions above do not depend on the command line tooling
+    import batch
+    parser = argparse.ArgumentParser(description="Convert navlab_smooth.bin to csv. Without arguments converts navlab_smooth.bin in the current folder.")
+    batch.add_batch_arguments(parser, cache=True)
+    parser.add_argument("--nth-row", type=int, default=10, help="Keep every nth row (default: 10).")
+    parser.add_argument("--columns", nargs="+", default=["timestamp", "lat", "lon",  "depth"], help="Columns to write, 'datetime' adds UTC date and time.")
+    args = parser.parse_args(argv)
+
+    if args.missions:
+        args.output_dir.mkdir(parents=True, exist_ok=True)
+        # .bin files, also from glob patterns, are converted as given, anything else is looked up as mission-folders
+        files = []
+        mission_folders = []
+        unresolved = []
+        for pattern in args.missions:
+            matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+            found = [Path(match) for match in matches if Path(match).is_file() and Path(match).suffix == ".bin"]
+            found += batch.expand_pattern(pattern)
+            if not found:
+                unresolved.append(pattern)
+            files.extend(path for path in found if path.is_file())
+            mission_folders.extend(path for path in found if path.is_dir())
+        if unresolved:
+            parser.error(f"no navlab .bin files or mission-folders found for {', '.join(unresolved)}")
+        mission_folders = list(dict.fromkeys(mission_folders))
+        try:
+            inputs = unique_outputs(files + mission_folders, args.output_dir)
+        except ValueError as error:
+            parser.error(str(error))
+        _, failed = batch.run_batch(convert_mission, inputs, args.workers, output_dir=args.output_dir, nth_row=args.nth_row, filter_columns=args.columns, cache_dir=args.cache_dir)
+        return batch.exit_status(failed)
 
-def main():
     print("Reading navlab_smooth.bin...")
-    df = read_navlab_smooth_to_dataframe("navlab_smooth.bin", nth_row=10, filter_columns=["timestamp", "lat", "lon",  "depth"])
-    df.to_csv("navlab_smooth.csv", index=False)
-    print("Converted navlab_smooth.bin to navlab_smooth.csv, every 10th rows.")
+    with stagetiming.mission_profile("navlab_smooth", Path("."), "pynavlab"):
+        write_navlab_smooth_csv("navlab_smooth.bin", "navlab_smooth.csv", nth_row=args.nth_row, filter_columns=args.columns)
+    print(f"Converted navlab_smooth.bin to navlab_smooth.csv, every {args.nth_row}th rows.")
 
 if __name__=='__main__':
-    main()
+    sys.exit(main())
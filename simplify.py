@@ -0,0 +1,85 @@
+import numpy as np
+
+# simplify.py
+# Douglas-Peucker simplification of lon/lat trajectories with a tolerance in metres.
+# Keeps vertices where the path turns and drops them along straight lines, unlike a fixed nth row stride.
+# Joakim Skjefstad
+
+earth_radius = 6371008.8 # metres, mean earth radius
+
+def project_local(lon, lat, lon0=None, lat0=None):
+    """Project lon/lat degrees to local east/north metres around (lon0, lat0), equirectangular."""
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    if lon0 is None:
+        lon0 = np.nanmean(lon) if lon.size else 0.0
+    if lat0 is None:
+        lat0 = np.nanmean(lat) if lat.size else 0.0
+    x = np.radians(lon - lon0) * earth_radius * np.cos(np.radians(lat0))
+    y = np.radians(lat - lat0) * earth_radius
+    return x, y
+
+def segment_distances(x, y, x0, y0, x1, y1):
+    """Distance from each point (x, y) to the segment (x0, y0)-(x1, y1)."""
+    dx = x1 - x0
+    dy = y1 - y0
+    length_squared = dx * dx + dy * dy
+    if length_squared == 0.0:
+        return np.hypot(x - x0, y - y0)
+    t = np.clip(((x - x0) * dx + (y - y0) * dy) / length_squared, 0.0, 1.0)
+    return np.hypot(x - (x0 + t * dx), y - (y0 + t * dy))
+
+def douglas_peucker_mask(x, y, tolerance):
+    """Boolean mask of the points kept by Douglas-Peucker, every dropped point is within tolerance of the result."""
+    number_of_points = len(x)
+    keep = np.zeros(number_of_points, dtype=bool)
+    if number_of_points == 0:
+        return keep
+    keep[0] = keep[-1] = True
+
+    # Iterative instead of recursive, trajectories can have millions of points
+    stack = [(0, number_of_points - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        distances = segment_distances(x[first + 1:last], y[first + 1:last], x[first], y[first], x[last], y[last])
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            index = first + 1 + farthest
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return keep
+
+def simplify_indices(lon, lat, tolerance):
+    """Indices of the lon/lat points to keep for a maximum deviation of tolerance metres. NaN positions are dropped."""
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    valid = np.flatnonzero(np.isfinite(lon) & np.isfinite(lat))
+    x, y = project_local(lon[valid], lat[valid])
+    return valid[douglas_peucker_mask(x, y, tolerance)]
+
+def simplify_coordinates(coordinates, tolerance):
+    """Simplify an (n, 2) array of lon/lat coordinates, tolerance in metres."""
+    coordinates = np.asarray(coordinates, dtype=np.float64)
+    if len(coordinates) == 0:
+        return coordinates
+    return coordinates[simplify_indices(coordinates[:, 0], coordinates[:, 1], tolerance)]
+
+def simplify_chunks(coordinate_chunks, tolerance):
+    """Simplify a stream of (n, 2) lon/lat chunks one chunk at a time, memory stays bounded by the chunk size."""
+    # Each chunk starts at the last point of the previous one, the endpoints are always kept so the
+    # tolerance holds over the whole line and chunks join without gaps
+    previous = None
+    for chunk in coordinate_chunks:
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if len(chunk) == 0:
+            continue
+        if previous is not None:
+            chunk = np.vstack((previous, chunk))
+        simplified = simplify_coordinates(chunk, tolerance)
+        if len(simplified) == 0:
+            continue
+        yield simplified if previous is None else simplified[1:]
+        previous = simplified[-1:]
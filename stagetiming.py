@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import argparse
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is then only sampled from /proc where that exists
+    resource = None
+
+# stagetiming.py
+# Optional instrumentation of the conversion pipeline: wall time, calls, records and bytes per stage and peak memory.
+# Off unless NAVTOOLS_PROFILE=1 is set or a tool is run with --profile, then every mission of a batch run writes
+# <output_dir>/<mission>_<tool>_profile.json. While off, stage() returns a shared no-op and costs next to nothing.
+# Stage times include stages nested inside them, e.g. navlab.datetime is part of navlab.decode.
+# Joakim Skjefstad
+
+environment_variable = "NAVTOOLS_PROFILE"
+memory_sample_interval = 0.05 # seconds between resident memory samples
+
+def enabled():
+    return os.environ.get(environment_variable, "") not in ("", "0")
+
+def enable():
+    # Through the environment, so worker processes of a batch run are profiled as well
+    os.environ[environment_variable] = "1"
+
+def resident_bytes():
+    """Current resident memory of this process, or the peak so far where the current value is not available."""
+    try:
+        with open("/proc/self/statm", 'r') as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == "Darwin" else peak * 1024
+    return 0
+
+class StageStatistics:
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.records = 0
+        self.bytes = 0
+        self.peak_resident_bytes = 0
+
+    def as_dict(self):
+        seconds = max(self.seconds, 1e-9)
+        return {
+            "calls": self.calls,
+            "seconds": self.seconds,
+            "records": self.records,
+            "bytes": self.bytes,
+            "records_per_second": self.records / seconds,
+            "megabytes_per_second": self.bytes / 1e6 / seconds,
+            "peak_resident_mb": self.peak_resident_bytes / 1e6,
+        }
+
+class NullStage:
+    """Stands in for Stage while profiling is off."""
+
+    def add(self, records=0, bytes=0):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+null_stage = NullStage()
+
+class Stage:
+    """One timed run of a stage, records and bytes are counted with add() while it runs."""
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+        self.records = 0
+        self.bytes = 0
+
+    def add(self, records=0, bytes=0):
+        self.records += records
+        self.bytes += bytes
+
+    def __enter__(self):
+        self.profile.begin(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profile.end(self, time.perf_counter() - self.start)
+
+class Profile:
+    """Stage statistics of one mission. A background thread samples resident memory while the profile is active."""
+
+    def __init__(self, name, tool=None):
+        self.name = name
+        self.tool = tool
+        self.stages = {}
+        self.active = {}
+        self.peak_resident_bytes = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample_memory, daemon=True)
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.sample()
+        self.sampler.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+        self.sample()
+        self.seconds = time.perf_counter() - self.start_time
+
+    def sample(self):
+        resident = resident_bytes()
+        with self.lock:
+            self.peak_resident_bytes = max(self.peak_resident_bytes, resident)
+            for stage in self.active:
+                statistics = self.stages[stage.name]
+                statistics.peak_resident_bytes = max(statistics.peak_resident_bytes, resident)
+
+    def sample_memory(self):
+        while not self.stopped.wait(memory_sample_interval):
+            self.sample()
+
+    def stage(self, name):
+        return Stage(self, name)
+
+    def begin(self, stage):
+        with self.lock:
+            self.stages.setdefault(stage.name, StageStatistics())
+            self.active[stage] = True
+        self.sample()
+
+    def end(self, stage, seconds):
+        self.sample()
+        with self.lock:
+            del self.active[stage]
+            statistics = self.stages[stage.name]
+            statistics.calls += 1
+            statistics.seconds += seconds
+            statistics.records += stage.records
+            statistics.bytes += stage.bytes
+
+    def report(self):
+        return {
+            "mission_name": self.name,
+            "tool": self.tool,
+            "seconds": self.seconds,
+            "peak_resident_mb": self.peak_resident_bytes / 1e6,
+            "stages": {name: statistics.as_dict() for name, statistics in sorted(self.stages.items())},
+        }
+
+# Profile of the mission being processed in this process, None when profiling is off
+current_profile = None
+
+def stage(name):
+    """Time a block as stage name of the current mission, a no-op when profiling is off."""
+    if current_profile is None:
+        return null_stage
+    return current_profile.stage(name)
+
+@contextmanager
+def mission_profile(mission_name, output_dir=Path("."), tool=None):
+    """Collect the stages run inside the block and write <output_dir>/<mission_name>_<tool>_profile.json."""
+    global current_profile
+    if not enabled():
+        yield None
+        return
+    profile = Profile(mission_name, tool)
+    current_profile = profile
+    profile.start()
+    try:
+        yield profile
+    finally:
+        profile.stop()
+        current_profile = None
+        report_path = Path(output_dir) / (f"{mission_name}_{tool}_profile.json" if tool else f"{mission_name}_profile.json")
+        with open(report_path, 'w') as report_file:
+            json.dump(profile.report(), report_file, indent=2)
+        print(f"Wrote {report_path}")
+
+def run_profiled(mission_folder, profiled_function, tool=None, **kwargs):
+    """profiled_function(mission_folder, **kwargs) inside a mission profile, module level so process pools can pickle it."""
+    with mission_profile(Path(mission_folder).name, kwargs.get("output_dir", Path(".")), tool):
+        return profiled_function(mission_folder, **kwargs)
+
+class EnableProfiling(argparse.Action):
+    """--profile flag, turns profiling on as soon as it is parsed."""
+
+    def __init__(self, option_strings, dest, **kwargs):
+        super().__init__(option_strings, dest, nargs=0, default=False, **kwargs)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        enable()
+        setattr(namespace, self.dest, True)
@@ -0,0 +1,57 @@
+import sys
+import json
+import argparse
+import subprocess
+from pathlib import Path
+
+# startupbudget.py
+# Measures how long importing each command line tool takes in a fresh interpreter and checks it against a budget.
+# pandas, tkinter, geojson and pyarrow are only imported when a tool needs them, a tool loading one of them at
+# import time also fails the check.
+# Joakim Skjefstad
+
+startup_budget_seconds = 0.3 # import time of one tool, numpy alone is about 0.1 s
+repeat = 5 # fresh interpreters per tool, the fastest one is reported
+
+tool_modules = (
+    "pynavlab", "navpos", "navp2geojson", "navigation2geojson", "mp2geojson", "lodpyramid",
+    "navcompare", "columnar", "missiondir", "missionmanifest", "missionexport", "navposlive", "crosstrack",
+    "archiveindex",
+)
+lazy_modules = ("pandas", "tkinter", "geojson", "pyarrow")
+
+measure_script = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+print(json.dumps({{"seconds": time.perf_counter() - start, "loaded": [name for name in {lazy_modules!r} if name in sys.modules]}}))
+"""
+
+def measure_import(module, repeat=repeat):
+    """Fastest import time of module over repeat fresh interpreters, and the lazy modules it loaded."""
+    best = None
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", measure_script.format(module=module, lazy_modules=lazy_modules)],
+                                capture_output=True, text=True, check=True, cwd=Path(__file__).parent).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+    return best
+
+def check_budget(modules=tool_modules, budget=startup_budget_seconds):
+    """Print the import time of every tool, return True if all are within budget without loading lazy modules."""
+    within_budget = True
+    for module in modules:
+        result = measure_import(module)
+        ok = result["seconds"] <= budget and not result["loaded"]
+        within_budget = within_budget and ok
+        loaded = f", loaded {', '.join(result['loaded'])}" if result["loaded"] else ""
+        print(f"{module:20s} {result['seconds'] * 1000:7.1f} ms{loaded}{'' if ok else '  OVER BUDGET'}")
+    return within_budget
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the import time of the command line tools against the startup budget.")
+    parser.add_argument("modules", nargs="*", default=list(tool_modules), help="Modules to measure (default: all tools).")
+    parser.add_argument("--budget", type=float, default=startup_budget_seconds, help=f"Seconds allowed per import (default: {startup_budget_seconds}).")
+    args = parser.parse_args()
+    sys.exit(0 if check_budget(args.modules, args.budget) else 1)
@@ -0,0 +1,137 @@
+import argparse
+import numpy as np
+from pathlib import Path
+
+# Import local module
+import pynavlab
+import navpos
+
+# syntheticmission.py
+# Writes a synthetic mission-folder for benchmarks and testing without vehicle data: post/navlab_smooth.bin,
+# postea/NN/Smoothing/PosteaSmooth-0000.bin variants, cp/data/format.txt + navpos.txt and mission.mp.
+# The vehicle runs a lawnmower survey at constant depth, navp is the same path with a few metres of noise.
+# Joakim Skjefstad
+
+start_timestamp = 1700000000.0 # 2023-11-14 22:13:20 UTC
+origin = (63.44, 10.40) # latitude, longitude of the survey's south-west corner
+metres_per_degree = 111320.0
+
+# Channels written to navpos.txt, in column order after Time
+navpos_channels = ["NAV_LATITUDE", "NAV_LONGITUDE", "NAV_DEPTH", "NAV_ALTITUDE", "NAV_HEADING"]
+navpos_group = "NAVIGATION_SYSTEM_DATA"
+
+def survey_path(duration, rate, speed=2.0, leg_length=1000.0, line_spacing=50.0):
+    """Time, east and north in metres and heading in degrees of a lawnmower survey sampled at rate Hz."""
+    time = np.arange(int(duration * rate)) / rate
+    distance = time * speed
+    leg_and_turn = leg_length + line_spacing
+    leg = np.floor(distance / leg_and_turn)
+    along = distance - leg * leg_and_turn
+    on_leg = along < leg_length
+    # Odd legs run back west, the line_spacing between legs is a straight run north
+    direction = np.where(leg % 2 == 0, 1.0, -1.0)
+    east = np.where(on_leg, np.where(direction > 0, along, leg_length - along), np.where(direction > 0, leg_length, 0.0))
+    north = leg * line_spacing + np.where(on_leg, 0.0, along - leg_length)
+    heading = np.where(on_leg, np.where(direction > 0, 90.0, 270.0), 0.0)
+    return time, east, north, heading
+
+def local_to_geodetic(east, north):
+    latitude = origin[0] + north / metres_per_degree
+    longitude = origin[1] + east / (metres_per_degree * np.cos(np.radians(origin[0])))
+    return latitude, longitude
+
+def navlab_records(duration, rate, rng, depth=50.0, speed=2.0):
+    """Structured navlab records (pynavlab.navlab_dtype) of the survey."""
+    time, east, north, heading = survey_path(duration, rate, speed)
+    records = np.zeros(len(time), dtype=pynavlab.navlab_dtype)
+    records["timestamp"] = start_timestamp + time
+    records["lat"], records["lon"] = local_to_geodetic(east, north)
+    records["depth"] = depth + 0.2 * np.sin(time / 30.0)
+    records["roll"] = rng.normal(0.0, 0.5, len(time))
+    records["pitch"] = rng.normal(0.0, 0.5, len(time))
+    records["heading"] = heading
+    records["vel_north"] = speed * np.cos(np.radians(heading))
+    records["vel_east"] = speed * np.sin(np.radians(heading))
+    for column, value in (("std_lat", 0.5), ("std_lon", 0.5), ("std_depth", 0.1), ("std_roll", 0.05), ("std_pitch", 0.05),
+                          ("std_heading", 0.1), ("std_vel_north", 0.01), ("std_vel_east", 0.01), ("std_vel_down", 0.01)):
+        records[column] = value
+    return records
+
+def write_navlab(path, records):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    records.tofile(path)
+
+def write_navpos(mission_folder_path, records, navlab_rate, navp_rate, rng, noise=2.0):
+    """format.txt and navpos.txt sampled from the navlab records at navp_rate Hz with noise metres of position error."""
+    data_dir = mission_folder_path / navpos.navpos_file_relative_path.parent
+    data_dir.mkdir(parents=True, exist_ok=True)
+    with open(mission_folder_path / navpos.format_file_relative_path, 'w') as format_file:
+        format_file.write("Format of navpos.txt\n1: Time\n")
+        for column, channel in enumerate(navpos_channels, start=2):
+            format_file.write(f"{column}: {navpos_group}    {channel}\n")
+
+    samples = records[::max(1, int(round(navlab_rate / navp_rate)))]
+    latitude_noise = rng.normal(0.0, noise, len(samples)) / metres_per_degree
+    longitude_noise = rng.normal(0.0, noise, len(samples)) / (metres_per_degree * np.cos(np.radians(origin[0])))
+    table = np.column_stack((
+        samples["timestamp"],
+        samples["lat"] + latitude_noise,
+        samples["lon"] + longitude_noise,
+        samples["depth"] + rng.normal(0.0, 0.1, len(samples)),
+        20.0 + rng.normal(0.0, 0.5, len(samples)),
+        samples["heading"],
+    ))
+    np.savetxt(mission_folder_path / navpos.navpos_file_relative_path, table, fmt=["%.3f", "%.8f", "%.8f", "%.2f", "%.2f", "%.2f"], delimiter="   ")
+
+def decimal_to_dmm(value, positive, negative, degree_digits):
+    """Decimal degrees to the Degrees:Minutes.decimalminutesDirection format of mission plans."""
+    direction = positive if value >= 0 else negative
+    degrees, minutes = divmod(abs(value) * 60, 60)
+    return f"{int(degrees):0{degree_digits}d}:{minutes:07.4f}{direction}"
+
+def write_missionplan(mission_folder_path, duration, depth=50.0, speed=2.0, leg_length=1000.0, line_spacing=50.0):
+    """mission.mp with a waypoint at both ends of every survey leg."""
+    legs = int(np.ceil(duration * speed / (leg_length + line_spacing)))
+    lines = ["# Synthetic mission plan"]
+    for leg in range(legs):
+        north = leg * line_spacing
+        ends = (0.0, leg_length) if leg % 2 == 0 else (leg_length, 0.0)
+        course = 90 if leg % 2 == 0 else 270
+        for east in ends:
+            latitude, longitude = local_to_geodetic(east, north)
+            tag = f"WP{len(lines):03d}"
+            lines.append(f":{tag}   {depth:.1f}   0   D   {decimal_to_dmm(latitude, 'N', 'S', 2)}   "
+                         f"{decimal_to_dmm(longitude, 'E', 'W', 3)}   {course}   G   {speed:.1f}   S   {int(leg_length / speed)}   {int(leg_length)}")
+    with open(mission_folder_path / "mission.mp", 'w') as mission_plan:
+        mission_plan.write("\n".join(lines) + "\n")
+
+def generate_mission(mission_folder_path, duration=3600.0, navlab_rate=100.0, navp_rate=10.0, postea_versions=2, seed=0):
+    """Write a synthetic mission-folder of duration seconds. postea/01 is identical to post, later versions are shifted."""
+    mission_folder_path = Path(mission_folder_path)
+    rng = np.random.default_rng(seed)
+    records = navlab_records(duration, navlab_rate, rng)
+    write_navlab(mission_folder_path / "post" / "navlab_smooth.bin", records)
+
+    for version in range(1, postea_versions + 1):
+        variant = records.copy()
+        if version > 1:
+            # Reprocessed solutions drift apart from the default from halfway through the mission
+            drift = np.clip(np.arange(len(variant)) - len(variant) // 2, 0, None) / max(len(variant), 1)
+            variant["lat"] += (version - 1) * 5.0 * drift / metres_per_degree
+        write_navlab(mission_folder_path / "postea" / f"{version:02d}" / "Smoothing" / "PosteaSmooth-0000.bin", variant)
+
+    write_navpos(mission_folder_path, records, navlab_rate, navp_rate, rng)
+    write_missionplan(mission_folder_path, duration)
+    return mission_folder_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic mission-folder for benchmarks and testing.")
+    parser.add_argument("mission", help="Mission-folder to write.")
+    parser.add_argument("--duration", type=float, default=3600.0, help="Mission length in seconds (default: 3600).")
+    parser.add_argument("--navlab-rate", type=float, default=100.0, help="navlab_smooth.bin records per second (default: 100).")
+    parser.add_argument("--navp-rate", type=float, default=10.0, help="navpos.txt rows per second (default: 10).")
+    parser.add_argument("--postea", type=int, default=2, help="postea/NN versions to write (default: 2).")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0).")
+    args = parser.parse_args()
+    generate_mission(args.mission, args.duration, args.navlab_rate, args.navp_rate, args.postea, args.seed)
+    print(f"Wrote {args.mission}")